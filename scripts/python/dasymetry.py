@@ -1,7 +1,10 @@
 from pathlib import Path
+import hashlib
+import numpy as np
 import geopandas as gpd
 import pandas as pd
-from tqdm import tqdm
+import pyogrio
+from shapely.geometry import box
 
 
 class Dasymetry:
@@ -15,6 +18,16 @@ class Dasymetry:
         # Add any top-level parameters here.
         self.rundir = rundir
 
+        # Cleaned GeoParquet copies of the loaded source files (see
+        # load_geodataframe), and the spatial join between the blocks and
+        # parcels (see spatialJoin)
+        self.cache_files = {}
+        self.source_files = None
+        self.join_cache = None
+
+        # Parcels contained in each block (see assignParcels)
+        self.adjacency = None
+
         return None
 
     def load_namelist(self, rundir):
@@ -101,6 +114,14 @@ class Dasymetry:
 
                 params[key] = Path(params[key])
 
+            # Optional filters applied when loading the source files. Empty
+            # or missing entries load the whole city.
+            params['borough'] = params.get('borough') or None
+            if params.get('bbox'):
+                params['bbox'] = tuple(float(val) for val in params['bbox'])
+            else:
+                params['bbox'] = None
+
         # Allowed densities are in units of people/acre. Convert to projection
         # units (1 acre = 4047 sq. m)
         params['top_den_allowed'] = [acre_to_sqft(val) for val
@@ -111,11 +132,18 @@ class Dasymetry:
         # Call function to assign landuse codes to their corresponding names
         assign_lot_codes()
 
-    def load_geodataframe(self, filename, fid='bbl'):
-        """ Method to load geometric data. Uses geopandas to load a shapefile
+    def load_geodataframe(self, filename, fid='bbl', fields=None, bbox=None,
+                          where=None):
+        """ Method to load geometric data. Uses pyogrio to load a shapefile
             into a GeoDataFrame, then performs some light cleaning of column
             names.
 
+            Only the fid and the requested fields are read, optionally
+            restricted to the features intersecting bbox and matching where.
+            The cleaned GeoDataFrame is saved as GeoParquet next to the
+            source file, keyed by a fingerprint of the source file and of
+            the load options, and later loads read it back instead.
+
             Input:
             ------
             filename (str): string describing file name of dataset
@@ -123,6 +151,14 @@ class Dasymetry:
             fid (str): Column name of parcel identifier.
             Default bbl from NYC MapPLUTO.
 
+            fields (list): Lowercase column names to keep. Default all.
+
+            bbox (tuple): (xmin, ymin, xmax, ymax) in the dataset's
+            projection. Default no filter.
+
+            where (dict): Lowercase column names and the value to keep in
+            each of them. Default no filter.
+
             Output:
             -------
             gdf: GeoDataFrame object containing data and geometry.
@@ -133,7 +169,36 @@ class Dasymetry:
 
         print('Loading data...')
 
-        df = gpd.read_file(filename)
+        options = repr((fid, fields, bbox, where))
+        key = self.fingerprint([filename], options)
+        cache = filename.parent / (filename.stem + '_' + key[:16] + '.parquet')
+        self.cache_files[filename] = cache
+
+        if cache.exists():
+            df = gpd.read_parquet(cache)
+            print(cache.name + ' loaded!')
+            return df
+
+        # Column names in the source keep their case, so match them on the
+        # lowercase names
+        info = pyogrio.read_info(filename)
+        names = {name.lower(): name for name in info['fields']}
+
+        # Filtered columns are read too, since GDAL only filters on the
+        # fields it reads
+        columns = None
+        if fields is not None:
+            columns = [fid] + list(fields) + list(where or {})
+            columns = [names[name] for name in dict.fromkeys(columns)
+                       if name in names]
+
+        sql = None
+        if where is not None:
+            sql = ' AND '.join('"{}" = \'{}\''.format(names[name], value)
+                               for name, value in where.items())
+
+        df = gpd.read_file(filename, engine='pyogrio', columns=columns,
+                           bbox=bbox, where=sql, use_arrow=True)
 
         print(filename.name + ' loaded!')
 
@@ -144,6 +209,11 @@ class Dasymetry:
         # df[fid] = df[fid].astype(int)
         df.set_index(fid, inplace=True)
 
+        if fields is not None:
+            df = df.loc[:, fields]
+
+        df.to_parquet(cache)
+
         return df
 
     def load_source_files(self, configdict):
@@ -160,26 +230,41 @@ class Dasymetry:
             attribute.
         """
 
-        population = (configdict['run_dir']
-                      / configdict['input_dir']
-                      / configdict['population_file'])
-
-        block_df = self.load_geodataframe(population,
-                                          configdict['population_fid'])
-        block_df = block_df.loc[:, self.configdict['block_fields']]
-
         parcels = (configdict['run_dir']
                    / configdict['input_dir']
                    / configdict['parcels_file'])
 
+        # Parcels can be restricted to one borough (e.g., QN in the MapPLUTO
+        # borough column) and to a bounding box
+        where = None
+        if configdict.get('borough') is not None:
+            where = {'borough': configdict['borough']}
+
         parcel_df = self.load_geodataframe(parcels,
-                                           configdict['parcels_fid'])
+                                           configdict['parcels_fid'],
+                                           configdict['parcel_fields'],
+                                           configdict.get('bbox'), where)
+
+        population = (configdict['run_dir']
+                      / configdict['input_dir']
+                      / configdict['population_file'])
+
+        # Blocks are read within the extent of the parcels, in the
+        # projection of the blocks
+        bbox = None
+        if where is not None or configdict.get('bbox') is not None:
+            block_crs = pyogrio.read_info(population)['crs']
+            extent = gpd.GeoSeries([box(*parcel_df.total_bounds)],
+                                   crs=parcel_df.crs)
+            bbox = tuple(extent.to_crs(block_crs).total_bounds)
 
-        parcel_df = parcel_df.loc[:, self.configdict['parcel_fields']]
+        block_df = self.load_geodataframe(population,
+                                          configdict['population_fid'],
+                                          configdict['block_fields'], bbox)
         # Create a new column in parcel_df, pop_name, to hold populations.
         # Initialize with zero.
         parcel_df[configdict['pop_name']] = 0
-        parcel_df.loc[:, 'numfloors'][parcel_df.loc[:, 'numfloors'] < 1] = 1
+        parcel_df.loc[parcel_df['numfloors'] < 1, 'numfloors'] = 1
 
         # Make sure the blocks and parcels are in the same map projection
         if block_df.crs != parcel_df.crs:
@@ -187,6 +272,8 @@ class Dasymetry:
 
         self.parcel_df = parcel_df
         self.block_df = block_df
+        self.source_files = (self.cache_files[population],
+                             self.cache_files[parcels])
 
         pop_name = self.configdict['pop_name']
         remaining = str(self.parcel_df[pop_name].sum())
@@ -200,23 +287,99 @@ class Dasymetry:
         parcels.to_file(outfile)  
         print('Done!')
 
+    def fingerprint(self, files, options=''):
+        """ Fingerprint of a set of source files, from their names and
+            contents, and of the options used to read them. Shapefiles are
+            read with their sidecar files, so every file sharing the stem of
+            a source file is included.
+        """
+
+        digest = hashlib.sha1(options.encode())
+        for source in files:
+            source = Path(source)
+            for path in sorted(source.parent.glob(source.stem + '.*')):
+                digest.update(path.name.encode())
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(2**20), b''):
+                        digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def spatialJoin(self, parcel_df, block_df):
+        """ Join cache shared by getOverpopParcels, assignParcels and
+            blocksToOverpop. Block and parcel centroids are computed once,
+            each layer gets a single spatial index, and both directions of
+            the containment relation are kept as integer position arrays:
+
+            block_in_parcel: (parcel, block) pairs where the block centroid
+            falls in the parcel
+            parcel_in_block: (block, parcel) pairs where the parcel centroid
+            falls in the block
+
+            When the frames come from load_source_files, the arrays are
+            saved next to the inputs keyed by a fingerprint of the source
+            files, so reruns on the same data skip the spatial work.
+
+            Output:
+            -------
+            Dictionary with the two relations, also kept as a class
+            attribute.
+        """
+
+        size = np.array([len(parcel_df), len(block_df)])
+        if (self.join_cache is not None
+                and np.array_equal(self.join_cache['size'], size)):
+            return self.join_cache
+
+        cache_file = None
+        if self.source_files is not None:
+            cache_file = (self.source_files[0].parent / ('spatial_join_'
+                          + self.fingerprint(self.source_files) + '.npz'))
+
+            if cache_file.exists():
+                with np.load(cache_file) as cached:
+                    join_cache = dict(cached)
+                if np.array_equal(join_cache['size'], size):
+                    self.join_cache = join_cache
+                    print('Spatial join loaded from ' + cache_file.name)
+                    return self.join_cache
+
+        block_centroid = block_df.centroid
+        parcel_centroid = parcel_df.centroid
+
+        # Query each layer's index with the centroids of the other one
+        block_pos, parcel_pos = parcel_df.sindex.query(block_centroid,
+                                                       predicate='intersects')
+        order = np.lexsort((block_pos, parcel_pos))
+        block_in_parcel = np.stack([parcel_pos[order], block_pos[order]])
+
+        parcel_pos, block_pos = block_df.sindex.query(parcel_centroid,
+                                                      predicate='intersects')
+        order = np.lexsort((parcel_pos, block_pos))
+        parcel_in_block = np.stack([block_pos[order], parcel_pos[order]])
+
+        self.join_cache = {'size': size,
+                           'block_in_parcel': block_in_parcel,
+                           'parcel_in_block': parcel_in_block}
+
+        if cache_file is not None:
+            np.savez(cache_file, **self.join_cache)
+
+        return self.join_cache
+
     def getOverpopParcels(self, parcel_df, block_df):
         """ Performs a spatial left join between parcels and blocks dataset.
             Then keep only the parcels that contain > 1 population blocks.
         """
-        # Create a copy of block_df with block centroids as geometry
-        parcel_df['overpopulated'] = False
-        block_centroid = block_df.copy()
-        block_centroid['geometry'] = block_centroid.centroid
 
-        # Find the lots that have > 1 census block within
-        overpop_parcels = gpd.sjoin(parcel_df, block_centroid)
+        # Find the lots that have > 1 census block centroid within
+        join = self.spatialJoin(parcel_df, block_df)
+        blocks_within = np.bincount(join['block_in_parcel'][0],
+                                    minlength=len(parcel_df))
+
         # Parcels that have more than one entry are considered overpopulated,
         # since they have > 1 census block within them.
-        overpop_bool = overpop_parcels.index.duplicated(keep=False)
-        overpop_index = overpop_parcels.loc[overpop_bool].index
-        overpop_index = list(set(overpop_index))
-        parcel_df['overpopulated'].loc[overpop_index] = True
+        parcel_df['overpopulated'] = blocks_within > 1
 
         print('Blocks assigned to overpopulated parcels')
 
@@ -225,37 +388,85 @@ class Dasymetry:
     def assignParcels(self, parcel_df, block_df):
         """ Assigns parcels to the block that contains them, excluding where
             parcel_df['overpolated'] is True.
-        """
 
-        # Create a new column in block_df to store contained parcels
-        block_df['parcels'] = [[]] * len(block_df)
-        block_df['parcels'] = block_df['parcels'].astype(object)
+            The assignment is kept as a compressed sparse row adjacency:
+            the parcels of the i-th block are the parcel positions
+            parcels[offsets[i]:offsets[i + 1]], and blocks holds the block
+            index label of every row.
 
-        # Get subset of non-overpopulated parcels, then sjoin to block_df
-        parcels_no_overpop = parcel_df[parcel_df['overpopulated'] == False]
-        parcels_centroid = parcels_no_overpop.copy()
+            Output:
+            -------
+            Creates the adjacency dictionary as a class attribute.
+        """
 
-        # To perform the sjoin we need a column named 'geometry'
-        parcels_centroid['geometry'] = parcels_centroid.centroid
-        blocks_joined = gpd.sjoin(block_df, parcels_centroid)
+        # Pairs of blocks and the centroids of non-overpopulated parcels
+        join = self.spatialJoin(parcel_df, block_df)
+        block_pos, parcel_pos = join['parcel_in_block']
 
-        blocks_unique_index = list(set(blocks_joined.index))
+        keep = ~parcel_df['overpopulated'].to_numpy(dtype=bool)[parcel_pos]
+        block_pos = block_pos[keep]
+        parcel_pos = parcel_pos[keep]
 
-        # For each block, list all parcels. Then convert to a GeoSeries to
-        # append to block_df
-        parcel_dict = {key: [blocks_joined.loc[key, 'index_right']] if
-                       not hasattr(blocks_joined.loc[key, 'index_right'],
-                                   '__iter__') else
-                       list(blocks_joined.loc[key, 'index_right'].values)
-                       for key in blocks_unique_index}
+        # Pairs are sorted by block, so the parcels of each block are
+        # contiguous and the row offsets follow from the counts
+        counts = np.bincount(block_pos, minlength=len(block_df))
+        offsets = np.r_[0, np.cumsum(counts)]
 
-        block_df['parcels'] = pd.Series(parcel_dict)
+        self.adjacency = {'blocks': block_df.index,
+                          'offsets': offsets,
+                          'parcels': parcel_pos}
 
         # Remove census blocks that intersect no parcels
         # block_df.dropna(subset=['parcels'], inplace=True)
 
         return None
 
+    def adjacencyEdges(self, block_index):
+        """ Edge table of the adjacency for a set of blocks, with one edge
+            per parcel contained in a block, in the order of block_index and
+            of the parcels of each block.
+
+            Input:
+            ------
+            block_index: index labels of the blocks (array-like)
+
+            Output:
+            -------
+            edge_block: position of the block of each edge in block_index
+            edge_parcel: position of the parcel of each edge in parcel_df
+        """
+
+        msg = 'Run assignParcels method!'
+        assert self.adjacency is not None, msg
+
+        offsets = self.adjacency['offsets']
+        rows = self.adjacency['blocks'].get_indexer(block_index)
+
+        # Blocks missing from the adjacency contain no parcels
+        counts = np.where(rows >= 0, offsets[rows + 1] - offsets[rows], 0)
+
+        edge_block = np.repeat(np.arange(len(rows)), counts)
+        edge_start = np.repeat(np.cumsum(counts) - counts, counts)
+        within = np.arange(counts.sum()) - edge_start
+        edge_parcel = self.adjacency['parcels'][np.repeat(offsets[rows],
+                                                          counts) + within]
+
+        return edge_block, edge_parcel
+
+    def subsetAdjacency(self, block_index):
+        """ Keep only the rows of the adjacency of the blocks in block_index,
+            in that order. Used when blocks are dropped from block_df.
+        """
+
+        edge_block, edge_parcel = self.adjacencyEdges(block_index)
+        counts = np.bincount(edge_block, minlength=len(block_index))
+
+        self.adjacency = {'blocks': pd.Index(block_index),
+                          'offsets': np.r_[0, np.cumsum(counts)],
+                          'parcels': edge_parcel}
+
+        return None
+
     def blockToParcel(self, block, parcel, numpeople):
         """ Method to transfer a number of people from a census block
             to a parcel contained within it. The block's population value
@@ -288,6 +499,42 @@ class Dasymetry:
 
         return None
 
+    def blocksToParcels(self, block_pos, parcel_pos, numpeople):
+        """ Vectorized version of blockToParcel over an edge table, where
+            edge i transfers numpeople[i] from block_pos[i] to parcel_pos[i].
+            Edges are applied in order with unbuffered ufunc.at updates, so
+            blocks and parcels that appear in several edges accumulate
+            exactly as with consecutive blockToParcel calls.
+
+            Input:
+            ------
+            block_pos: positions of source census blocks in block_df
+            (array-like)
+            parcel_pos: positions of target parcels in parcel_df (array-like)
+            numpeople: Number of people transfered along each edge
+            (array-like)
+
+            Output:
+            -------
+            None
+        """
+
+        parcels = self.parcel_df
+        blocks = self.block_df
+
+        pop_name = self.configdict['pop_name']
+
+        parcel_pop = parcels[pop_name].to_numpy(dtype=float, copy=True)
+        block_pop = blocks[pop_name].to_numpy(dtype=float, copy=True)
+
+        np.add.at(parcel_pop, parcel_pos, numpeople)
+        np.subtract.at(block_pop, block_pos, numpeople)
+
+        parcels[pop_name] = parcel_pop
+        blocks[pop_name] = block_pop
+
+        return None
+
     def blocksToOverpop(self, parcels, blocks):
         """ Add the population of blocks within overpopulated parcels (ie,
             parcels that contain > 1 census block) and add to parcel.
@@ -297,26 +544,25 @@ class Dasymetry:
         assert check, msg
 
         pop_name = self.configdict['pop_name']
-        # Get a copy withof blocks with centroids as geometry
-        block_centroid = blocks.copy()
-        block_centroid['geometry'] = block_centroid.centroid
 
-        # We only want to operate on overpopulated parcels.
-        overpop_parcels = parcels[parcels['overpopulated'].__eq__(True)]
+        # We only want to operate on overpopulated parcels, and the blocks
+        # whose centroids they contain.
+        join = self.spatialJoin(parcels, blocks)
+        parcel_pos, block_pos = join['block_in_parcel']
 
-        # Spatial join of the overpopulated parcels with the source blocks.
-        overpop_join = gpd.sjoin(overpop_parcels, block_centroid)
+        overpop = parcels['overpopulated'].to_numpy(dtype=bool)[parcel_pos]
+        parcel_pos = parcel_pos[overpop]
+        block_pos = block_pos[overpop]
 
         # Add the populations of all blocks, by containing parcel, then
         # assign added value to parcels_df.
-        popname_right = pop_name + '_right'
-        overpop_join  = pd.DataFrame(overpop_join).drop('geometry', axis = 1) 
-        pop = overpop_join.groupby(by=overpop_join.index).sum()[popname_right]
+        block_pop = blocks[pop_name].to_numpy()[block_pos]
+        pop = pd.Series(block_pop).groupby(parcels.index[parcel_pos]).sum()
 
         parcels.loc[pop.index, pop_name] = pop
 
         # Now we "empty" out the census blocks in the overpop parcels
-        blocks.loc[overpop_join['index_right'], pop_name] = 0
+        blocks.loc[blocks.index[block_pos], pop_name] = 0
 
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
@@ -329,18 +575,23 @@ class Dasymetry:
 
         """
 
+        # One edge per parcel contained in a block, in the order of the
+        # blocks and of their parcels
+        edge_block, edge_parcel = self.adjacencyEdges(blocks.index)
+        resunits = parcels[self.configdict['res_units']]
+        resunits = resunits.to_numpy(dtype=float)[edge_parcel]
+
         # Define functions used in the disaggregation logic
-        def sum_units(parcel_list):
+        def sum_units():
             """ Function to sum the number of residential units of all parcels
-                contained in a single census block.
-
-                Input:
-                ------
-                blockid: Census block ID, used as index in self.blocks_df
+                contained in each census block. Blocks that contain no
+                parcels get NaN.
             """
-            contained = parcels.loc[parcel_list,
-                                    self.configdict['res_units']]
-            contained_sum = contained.sum()
+            contained_sum = np.bincount(edge_block,
+                                        weights=np.nan_to_num(resunits),
+                                        minlength=len(blocks))
+            counts = np.bincount(edge_block, minlength=len(blocks))
+            contained_sum[counts == 0] = np.nan
             return contained_sum
 
         def compute_pop_resunit(blocks):
@@ -351,52 +602,51 @@ class Dasymetry:
 
             blocks['pop_resunits_ratio'] = blocks[pop_name]/blocks[contained]
 
-        def distribute_by_resunits(blocks, how='compute'):
+        def distribute_by_resunits(block_mask, how='compute'):
             """ Distribute population from a census block to its contained
                 parcels according to its proportion of residential units.
+                All (block, parcel) pairs of the blocks in block_mask are
+                handled at once as the rows of the edge table.
             """
-            unitresname = self.configdict['res_units']
             pop_name = self.configdict['pop_name']
             top_hhsize = self.configdict['top_hh_size']
 
-            # Looping through all blocks for now. We can think of other ways
-            # to do this (maybe an "apply"?) to speed it up.
-            for blockid, row in tqdm(blocks.iterrows()):
-                total_resunits = blocks.loc[blockid, 'contained_resunits']
-                # Call blockToParcel
-                for parcel in blocks.loc[blockid, 'parcels']:
-                    # Compute proportion of res units per parcel
-                    if how == 'compute':
-                        proportion = parcels.loc[parcel,
-                                                 unitresname]/total_resunits
-                        numpeople = blocks.loc[blockid, pop_name]*proportion
-                    elif how == 'max':
-                        numpeople = top_hhsize*parcels.loc[parcel, unitresname]
-                    else:
-                        raise Exception('kwarg how ' + how + ' is invalid')
-
-                    # Call blockToParcel to assign numpeople to parcel
-                    self.blockToParcel(blockid, parcel, numpeople)
+            if how not in ('compute', 'max'):
+                raise Exception('kwarg how ' + how + ' is invalid')
+
+            keep = block_mask[edge_block]
+            block_pos = edge_block[keep]
+            parcel_pos = edge_parcel[keep]
+
+            # Compute proportion of res units per parcel
+            if how == 'compute':
+                total_resunits = blocks['contained_resunits']
+                total_resunits = total_resunits.to_numpy(dtype=float)
+                block_pop = blocks[pop_name].to_numpy(dtype=float)
+                proportion = resunits[keep]/total_resunits[block_pos]
+                numpeople = block_pop[block_pos]*proportion
+            else:
+                numpeople = top_hhsize*resunits[keep]
+
+            # Assign numpeople to all parcels in one update
+            self.blocksToParcels(block_pos, parcel_pos, numpeople)
 
         top_hh_size = self.configdict['top_hh_size']
         pop_name = self.configdict['pop_name']
-        # Subset blocks to only those that contain parcels. We do this in Case
-        # our census block data does not perfectly align with parcels data.
-        blocks_withparcels = blocks.dropna(subset=['parcels'])
 
-        # create a new column to hold the total residential units in a block
-        # blocks_withparcels.loc[:, 'contained_resunits'] = 0
-
-        block_res = blocks_withparcels.loc[:, 'parcels'].apply(sum_units)
-        blocks.loc[block_res.index, 'contained_resunits'] = block_res.values
+        # Total residential units of the blocks that contain parcels. Blocks
+        # without parcels are left out, in case our census block data does
+        # not perfectly align with parcels data.
+        blocks['contained_resunits'] = sum_units()
 
         # Compute the block population per residential units ratio
         compute_pop_resunit(blocks)
 
         # Get all blocks where pop_resunits_ratio < top_hh_size
         # blocks_below_tophh
-        below_tophh = blocks[blocks['pop_resunits_ratio'] <= top_hh_size]
-        above_tophh = blocks[blocks['pop_resunits_ratio'] > top_hh_size]
+        ratio = blocks['pop_resunits_ratio'].to_numpy(dtype=float)
+        below_tophh = ratio <= top_hh_size
+        above_tophh = ratio > top_hh_size
 
         # Distribute population based on proportion of residential units.
         distribute_by_resunits(below_tophh, how='compute')
@@ -404,8 +654,13 @@ class Dasymetry:
         # For lots where hh_size is above allowed value
         distribute_by_resunits(above_tophh, how='max')
 
-        blocks.loc[:, pop_name][blocks[pop_name] < 0.25] = 0
-        blocks.dropna(subset=['parcels'], inplace=True)
+        blocks.loc[blocks[pop_name] < 0.25, pop_name] = 0
+
+        # Remove census blocks that contain no parcels, from both block_df
+        # and the adjacency
+        no_parcels = np.isnan(blocks['contained_resunits'].to_numpy())
+        blocks.drop(index=blocks.index[no_parcels], inplace=True)
+        self.subsetAdjacency(blocks.index)
 
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
@@ -433,69 +688,86 @@ class Dasymetry:
 
             return allowed
 
-        def distribute_by_areaproportion(blockid, remainder=False):
-            subset = parcels.loc[blocks_left.loc[blockid, 'parcels']]
-            subset = subset[subset['landuse'].isin(code)]
-
-            if remainder is False:
-                subset = subset[subset['allowed'] > 0]
-
-            total_area = subset['lotarea'].sum()
-            subset['areaprop'] = subset['lotarea']/total_area
+        # Edge table with one row per parcel contained in a block, in the
+        # order of the blocks and of their parcels
+        edge_block, edge_parcel = self.adjacencyEdges(blocks.index)
 
-            if len(subset) == 1:
-                if remainder is False:
-
-                    numpeople = subset['allowed'].values[0]
-                else:
-                    # print('Distributing reminder population')
-                    numpeople = blocks.loc[blockid, pop_name]
+        # Landuse encoded once as a mask of parcels per lot type
+        lot_masks = []
+        for lot_type in self.configdict['lot_types']:
+            codename = '_'.join([lot_type, 'codes'])
+            code = self.configdict[codename]
+            lot_masks.append(parcels['landuse'].isin(code).to_numpy())
 
-                self.blockToParcel(blockid,
-                                   subset.index[0],
-                                   numpeople)
+        lotarea = parcels['lotarea'].to_numpy(dtype=float)
 
-            elif len(subset) == 0:
-                pass
+        def distribute_by_areaproportion(lot_mask, remainder=False):
+            """ Distribute the population of all blocks with leftover
+                population to their parcels of one lot type, by area
+                proportion. Parcels of a block are served in order, each
+                taking its share of what the block still holds, capped by
+                its allowed population unless distributing the remainder.
+            """
+            block_pop = blocks[pop_name].to_numpy(dtype=float)
+            allowed = parcels['allowed'].to_numpy(dtype=float)
 
+            keep = (block_pop[edge_block] > 0) & lot_mask[edge_parcel]
+            if remainder is False:
+                keep &= allowed[edge_parcel] > 0
+
+            block_pos = edge_block[keep]
+            parcel_pos = edge_parcel[keep]
+            if len(block_pos) == 0:
+                return None
+
+            # Edges of a block are contiguous. Area proportions come from the
+            # total area of each group, where missing lot areas are skipped
+            # as by Series.sum
+            new_block = np.r_[True, block_pos[1:] != block_pos[:-1]]
+            starts = np.flatnonzero(new_block)
+            sizes = np.diff(np.r_[starts, len(block_pos)])
+            areas = lotarea[parcel_pos]
+            total_area = np.add.reduceat(np.nan_to_num(areas), starts)
+            areaprop = areas/np.repeat(total_area, sizes)
+
+            # Step through the parcels of all blocks by their rank in the
+            # block, updating what each block still holds
+            numpeople = np.empty(len(block_pos))
+            held = block_pop.copy()
+            for rank in range(sizes.max()):
+                cur = starts[sizes > rank] + rank
+                share = areaprop[cur]*held[block_pos[cur]]
+                if remainder is False:
+                    cap = allowed[parcel_pos[cur]]
+                    share = np.where(share < cap, share, cap)
+                numpeople[cur] = share
+                held[block_pos[cur]] = held[block_pos[cur]] - share
+
+            # A block with a single parcel gives it its whole allowed value,
+            # or its whole population when distributing the remainder
+            single = np.repeat(sizes == 1, sizes)
+            if remainder is False:
+                numpeople[single] = allowed[parcel_pos[single]]
             else:
-                for bbl in subset.index:
-                    numpeople = subset.loc[bbl,
-                                           'areaprop']*blocks.loc[blockid,
-                                                                  pop_name]
-                    if remainder is False:
-                        if (numpeople < subset.loc[bbl, 'allowed']):
-                            self.blockToParcel(blockid, bbl, numpeople)
-                        else:
-                            numpeople = subset.loc[bbl, 'allowed']
-                            self.blockToParcel(blockid, bbl, numpeople)
-                    else:
-                        self.blockToParcel(blockid, bbl, numpeople)
+                numpeople[single] = block_pop[block_pos[single]]
+
+            self.blocksToParcels(block_pos, parcel_pos, numpeople)
 
             return None
 
         for n, lot_type in enumerate(self.configdict['lot_types']):
             max_dens = self.configdict['top_den_allowed'][n]
-            codename = '_'.join([lot_type, 'codes'])
-            code = self.configdict[codename]
             parcels['allowed'] = allowable()
 
-            blocks_left = blocks[blocks[pop_name] > 0]
             print('Distributing by area proportion')
-            for blockid, row in tqdm(blocks_left.iterrows()):
-                distribute_by_areaproportion(blockid)
+            distribute_by_areaproportion(lot_masks[n])
 
         # We take whatever folks are left from the previous step, and we
         # assign them to the landuse types in lot_types, without regard to
         # the allowable field.
         for n, lot_type in enumerate(self.configdict['lot_types']):
-            codename = '_'.join([lot_type, 'codes'])
-            code = self.configdict[codename]
-
-            blocks_left = blocks[blocks[pop_name] > 0]
             print('Distributing the leftovers...')
-            for blockid, row in tqdm(blocks_left.iterrows()):
-                distribute_by_areaproportion(blockid, remainder=True)
+            distribute_by_areaproportion(lot_masks[n], remainder=True)
 
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
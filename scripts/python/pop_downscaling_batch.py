@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import multiprocessing
+import concurrent.futures
+import pandas as pd
+
+
+sys.path.append(os.path.join('.', 'scripts', 'python'))
+import pop_downscaling_module_parallel as pdm
+import pop_downscaling_calibration_parallel as pdc
+
+
+
+# Batch inputs -- every (borough, scenario) pair is a job. Calibration is run once per borough and the
+# scenarios of a borough share its mask, indices and stencil
+boroughs         = ['Bronx', 'Brooklyn', 'Manhattan', 'Queens', 'Staten Island']
+scenarios        = ['SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5']
+jobs             = [(borough, scenario) for borough in boroughs for scenario in scenarios]
+run_calibration  = True
+projection_years = range(2020, 2100, 10)
+
+
+# Worker budget shared by all the jobs, split evenly between the boroughs that run concurrently
+worker_budget       = max(multiprocessing.cpu_count() - 1, 1)
+concurrent_boroughs = min(len(boroughs), worker_budget)
+
+
+# Per-job wall time and throughput
+batch_report = os.path.join('.', 'outputs', 'population_downscaling', 'batch_report.csv')
+
+
+
+
+#=========================================================================================
+def _worker_init(workers):
+
+    # Each borough process gets its share of the worker budget for the pools, FFTs and threads
+    pdm.max_workers = workers
+
+
+
+
+#=========================================================================================
+def borough_jobs(borough, borough_scenarios, run_calibration):
+
+    # Define local variables
+    report = [] # Rows with wall time and throughput of each task
+
+
+    # Calibration inputs of the borough
+    calibration_path = os.path.join(pdc.calibration_inputs_path, borough)
+    mask_raster      = os.path.join(calibration_path, 'mask_raster.tif')
+    point_indices    = os.path.join(calibration_path, 'within_indices.rds')
+    cells            = len(pdm.read_within_indices(point_indices))
+
+    if run_calibration:
+        calibration_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'calibration', borough)
+        os.makedirs(calibration_outputs, exist_ok=True)
+
+        start = time.perf_counter()
+        pdc.calibration(os.path.join(calibration_path, 'pop_grid_2010.tif'),
+                        os.path.join(calibration_path, 'pop_grid_2020.tif'), mask_raster, point_indices,
+                        pdc.neighborhood_dis, pdc.suitability_engine, pdc.pyramid_factor, pdc.kernel_tolerance,
+                        calibration_outputs)
+        wall_time = time.perf_counter() - start
+
+        report.append({'borough': borough, 'scenario': None, 'task': 'calibration', 'wall_time': wall_time,
+                       'cells': cells, 'decades': 0, 'cells_per_second': cells / wall_time})
+
+
+    # Inputs shared by the scenarios of the borough
+    static_inputs = pdc.projection_static_inputs(mask_raster, point_indices, pdc.neighborhood_dis)
+
+    for scenario in borough_scenarios:
+        projection_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'projection',
+                                          scenario, borough)
+        os.makedirs(projection_outputs, exist_ok=True)
+
+        start = time.perf_counter()
+        pdc.pop_projection_series(os.path.join(pdc.projection_inputs_path, borough, 'pop_grid_2020.tif'),
+                                  mask_raster,
+                                  os.path.join(pdc.projection_inputs_path,
+                                               'pop_projections_bor_agg_' + scenario + '.csv'),
+                                  point_indices,
+                                  os.path.join(pdc.projection_inputs_path, borough,
+                                               'parameters_' + scenario + '.csv'),
+                                  pdc.neighborhood_dis, scenario, pdc.suitability_engine, projection_years,
+                                  pdc.kernel_tolerance, static_inputs, pdc.output_stack,
+                                  projection_outputs=projection_outputs)
+        wall_time = time.perf_counter() - start
+
+        report.append({'borough': borough, 'scenario': scenario, 'task': 'projection', 'wall_time': wall_time,
+                       'cells': cells, 'decades': len(projection_years),
+                       'cells_per_second': cells * len(projection_years) / wall_time})
+
+    return report
+
+
+
+
+#=========================================================================================
+def batch(jobs, run_calibration=True, worker_budget=worker_budget, concurrent_boroughs=concurrent_boroughs):
+
+    # Group the scenarios by borough, keeping the order of the jobs
+    borough_scenarios = {}
+    for borough, scenario in jobs:
+        borough_scenarios.setdefault(borough, []).append(scenario)
+
+    # Independent boroughs run concurrently, each with its share of the worker budget
+    processes = max(min(concurrent_boroughs, len(borough_scenarios)), 1)
+    workers   = max(worker_budget // processes, 1)
+
+    start  = time.perf_counter()
+    report = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_worker_init,
+                                                initargs=(workers,)) as executor:
+        futures = [executor.submit(borough_jobs, borough, cur_scenarios, run_calibration)
+                   for borough, cur_scenarios in borough_scenarios.items()]
+        for future in futures:
+            report.extend(future.result())
+
+    report = pd.DataFrame(report)
+    print(report.to_string(index=False))
+    print("batch wall time: {:.1f} s for {} jobs".format(time.perf_counter() - start, len(jobs)))
+
+    return report
+
+
+
+
+#=========================================================================================
+
+if __name__ == '__main__':
+
+    report = batch(jobs, run_calibration, worker_budget, concurrent_boroughs)
+    report.to_csv(batch_report, index=False)
@@ -1,11 +1,8 @@
 import os
 import sys
 import numpy as np
-import pyreadr
 import pandas as pd
 import scipy.optimize
-import multiprocessing
-from pathos.multiprocessing import ProcessingPool as Pool
 
 
 sys.path.append(os.path.join('.', 'scripts', 'python'))
@@ -19,13 +16,26 @@ calibration_inputs_path = os.path.join('.', 'inputs', 'main_downscaling_inputs',
 pop_fst_year  = os.path.join(calibration_inputs_path, borough, 'pop_grid_2010.tif') 
 pop_snd_year  = os.path.join(calibration_inputs_path, borough, 'pop_grid_2020.tif') 
 mask_raster   = os.path.join(calibration_inputs_path, borough, 'mask_raster.tif') 
-point_indices = os.path.join(calibration_inputs_path, borough, 'within_indices.rds')  
-point_coors   = os.path.join(calibration_inputs_path, borough, 'coors.csv') 
+point_indices = os.path.join(calibration_inputs_path, borough, 'within_indices.rds') # Converted once to a .npy store
+
+# Calibration periods as (start grid, end grid) pairs of the borough; with more than one, all periods
+# and their pooled estimate are fitted in one run
+calibration_pairs = [(pop_fst_year, pop_snd_year)]
 
 
 # Projection inputs
 scenario               = 'SSP1'
 neighborhood_dis       = 25000
+suitability_engine     = 'fft' # 'fft' (grid-level convolution), 'sparse' (cached neighbour matrix),
+                               # 'auto' (compiled per-cell loop when numba is available, 'pool'
+                               # otherwise), 'numba', 'shared' (persistent per-cell pool) or 'pool'
+                               # (per-cell, for verification)
+pyramid_factor         = 1     # Cells aggregated per side for a coarse calibration pass (1 disables it)
+kernel_tolerance       = None  # Relative weight exp(-b*d) below which neighbors are dropped (None keeps
+                               # the full neighborhood)
+output_stack           = False # Write all decades as bands of one tiled, compressed GeoTIFF instead of
+                               # a GeoTIFF per decade
+ensemble_members       = 0     # Members of a Monte Carlo ensemble over perturbed alpha and beta (0 skips it)
 projection_inputs_path = os.path.join('.', 'inputs', 'main_downscaling_inputs', 'projection')
 aggregate_projections  = os.path.join(projection_inputs_path,
                                       'pop_projections_bor_agg_' + scenario  + '.csv')
@@ -33,27 +43,46 @@ first_pop_grid         = os.path.join(projection_inputs_path, borough, 'pop_grid
 params_file            = os.path.join(projection_inputs_path, borough, 'parameters_' + scenario  + '.csv')
 
 
+# City-wide projection on one NYC grid, split into tiles with a halo of the neighborhood distance. The
+# borough raster holds the codes below, and totals are still constrained per borough
+city_wide        = False
+city_tile_size   = 256 # Cells per tile side
+city_inputs_path = os.path.join(projection_inputs_path, 'NYC')
+borough_raster   = os.path.join(city_inputs_path, 'borough_raster.tif')
+borough_codes    = {1: 'Manhattan', 2: 'Bronx', 3: 'Brooklyn', 4: 'Queens', 5: 'Staten Island'}
+
+
+# Warm projection session serving what-if queries of the borough over a local socket instead of the run.
+# Clients authenticate with the key in the POP_SESSION_AUTHKEY environment variable, which must be set
+serve_session   = False
+session_address = ('localhost', 6010)
+session_authkey = os.environ.get('POP_SESSION_AUTHKEY')
+
+
+# Neighborhood stencils (and neighbour matrices) cached by grid shape, resolution and cut-off distance
+stencil_cache = os.path.join('.', 'outputs', 'population_downscaling', 'stencils')
+
+# Unmasked suitability estimates of the first projected decade, reused when only the mask changes. The
+# projection writes them only when enabled (a file per scenario and parameter set), and pop_reprojection
+# writes them when they are missing
+cache_suitability     = False
+suitability_cache_dir = os.path.join('.', 'outputs', 'population_downscaling', 'suitability')
+
+
 # Calibration outputs
-try:
-    calibration_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'calibration', borough)
-    os.makedirs(calibration_outputs)
-except:
-    print('The folder already exists!')
+calibration_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'calibration', borough)
 
 
 # Projection outputs
-try:
-    projection_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'projection', scenario,
-                                      borough)
-    os.makedirs(projection_outputs)
-except:
-    print("The folder already exists!")
+projection_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'projection', scenario, borough)
 
 
 
 
 #=========================================================================================
-def calibration(pop_fst_year, pop_snd_year, mask_raster, point_indices, point_coors, neighborhood_dis):
+def calibration(pop_fst_year, pop_snd_year, mask_raster, point_indices, neighborhood_dis,
+                suitability_engine, pyramid_factor=1, kernel_tolerance=None,
+                calibration_outputs=calibration_outputs):
 
     # Define local variables    
     pop_files       = [] # List containing population grids
@@ -65,81 +94,213 @@ def calibration(pop_fst_year, pop_snd_year, mask_raster, point_indices, point_co
     ## baseline population grids
     pop_files.append(pop_fst_year)
     pop_files.append(pop_snd_year)
-
-   
-    #Populate the array containing mask values 
-    points_mask = pdm.raster_to_array(mask_raster)
     
 
-    # Read historical population grids into arrrays
-    population_1st = pdm.raster_to_array(pop_files[0])        
-    population_2nd = pdm.raster_to_array(pop_files[1])
+    # Read indices of points that fall within the state boundary
+    within_indices = pdm.read_within_indices(point_indices)
     
     
-    # All indices
-    all_indices = pdm.all_index_retriever(pop_fst_year, ['row', 'column'])
+    # Rasters are only read over the window of the within-boundary cells and their neighborhood
+    window         = pdm.RasterWindow(mask_raster, within_indices, neighborhood_dis)
+    within_indices = window.within_indices
+
+   
+    #Populate the array containing mask values 
+    points_mask = window.read(mask_raster)
     
 
-    # Read indices of points that fall within the state boundary
-    within_indices = pyreadr.read_r(point_indices)
-    within_indices = pd.DataFrame(list(within_indices.values())[0])
-    within_indices = list(within_indices.loc[:, 'index'].astype(int).values)
+    # Read historical population grids into arrrays
+    population_1st = window.read(pop_files[0])        
+    population_2nd = window.read(pop_files[1])
+    shape          = window.shape
+    resolution     = window.resolution
 
 
     # Calculate a distance matrix that serves as a template
     cut_off_meters = neighborhood_dis
-    dist_matrix    = pdm.dist_matrix_calculator(within_indices[0], cut_off_meters, all_indices, point_coors)
+    dist_matrix    = pdm.stencil_generator(shape, resolution, cut_off_meters, stencil_cache)
+
+
+    # The suitability engine is built once and reused by every evaluation of the objective, and released
+    # even if the calibration fails
+    engine = pdm.suitability_engine(suitability_engine, population_1st, dist_matrix, within_indices, shape,
+                                    stencil_cache, kernel_tolerance)
 
          
-    # Initial alpha values
-    a_lower = -1.0
-    a_upper = 1.0 
-    
-    # Initial beta values
-    b_lower = 0
-    b_upper = 1
+    try:
+        # Initial alpha values
+        a_lower = -1.0
+        a_upper = 1.0 
+        
+        # Initial beta values
+        b_lower = 0
+        b_upper = 1
+                
+
+        # Parameters to be used in optimization        
+        params = (population_1st, population_2nd, points_mask, dist_matrix, within_indices, shape, engine)
+        
+        # Evaluations of the objective are memoized on disk and reused by later runs on the same inputs
+        objective = pdm.ObjectiveCache(os.path.join(calibration_outputs, 'objective_cache.csv'), params)
+        
+        
+        # Values of alpha and beta evaluated by the brute force
+        a_list = np.linspace(a_lower, a_upper, 10)
+        b_list = np.linspace(b_lower, b_upper, 5)
+        
+        if pyramid_factor > 1:
             
+            # Run the brute force and a first optimization on aggregated grids, where they are much cheaper
+            coarse_params    = pdm.pyramid_level(params, resolution, cut_off_meters, pyramid_factor,
+                                                 suitability_engine, stencil_cache, kernel_tolerance)
+            try:
+                coarse_objective = pdm.ObjectiveCache(os.path.join(calibration_outputs, 'objective_cache.csv'),
+                                                      coarse_params)
+                fst_results      = coarse_objective.grid_search(a_list, b_list, *coarse_params)
+                (a0, b0)         = fst_results.loc[fst_results['estimate'].idxmin(), ['a', 'b']] 
+                
+                # The coarse optimum only approximates the full resolution one, so it is not polished further than
+                # a thousandth of the best brute force error
+                coarse_parameters = scipy.optimize.minimize(coarse_objective, x0 = (a0, b0), 
+                                                            args = coarse_params, method = 'SLSQP',
+                                                            options = {'disp' : True, 'eps': 0.01, 
+                                                                       'ftol': 1e-3 * fst_results['estimate'].min()},
+                                                            bounds = ((-2.0, 2.0), (-0.5, 2.0)))
+                print(coarse_objective.report())
+            finally:
+                coarse_params[6].close()
+            
+            # The full resolution optimization only refines the coarse optimum: it is confined to one step of
+            # the brute force grid around it and to a few iterations
+            (a0, b0) = coarse_parameters['x']
+            a_step   = a_list[1] - a_list[0]
+            b_step   = b_list[1] - b_list[0]
+            bounds   = ((max(a0 - a_step, -2.0), min(a0 + a_step, 2.0)), 
+                        (max(b0 - b_step, -0.5), min(b0 + b_step, 2.0)))
+            options  = {'disp' : True, 'eps': 0.01, 'ftol': 0.01, 'maxiter': 2}
+            
+            # The brute force ran on the coarse grid
+            brute_force_csv = os.path.join(calibration_outputs, 'initial_values_coarse.csv')
+        
+        else:
+            
+            # Run brute force over the whole grid in one batched pass
+            fst_results = objective.grid_search(a_list, b_list, *params)
+            
+            # Use the point with the minimum value as an initial guess for the second optimizer
+            (a0, b0) = fst_results.loc[fst_results['estimate'].idxmin(), ['a', 'b']] 
+            bounds   = ((-2.0, 2.0), (-0.5, 2.0))
+            options  = {'disp' : True, 'eps': 0.01, 'ftol': 0.01}
+            
+            brute_force_csv = os.path.join(calibration_outputs, 'initial_values.csv')
+        
 
-    # Parameters to be used in optimization        
-    params = (population_1st, population_2nd, points_mask, dist_matrix, within_indices)
+        # Save the current optimization file
+        fst_results.to_csv(brute_force_csv)
+        
+        
+        # Final optimization
+        parameters = scipy.optimize.minimize(objective, x0 = (a0, b0), 
+                                                args = params, method = 'SLSQP',
+                                                options = options, bounds = bounds)
+        
+
+        # Write the parameters to the designated csv file
+        parameters_dict        = pd.DataFrame({'alpha':[parameters['x'][0]] * 9, 'beta':[parameters['x'][1]] * 9,
+                                                'scenario':['SSP2'] * 9, 'year': list(range(2020, 2110, 10))})
+        output_parameters_file = os.path.join(calibration_outputs, 'parameters_SSP2.csv')
+        parameters_dict.to_csv(output_parameters_file)
+        
+        print(objective.report())
+    finally:
+        engine.close()
+
+
+
+
+#=========================================================================================
+def calibration_periods(periods, mask_raster, point_indices, neighborhood_dis, suitability_engine,
+                        kernel_tolerance=None, calibration_outputs=calibration_outputs):
     
+    # Calibrate several (start grid, end grid) periods of the same borough in one run. The window,
+    # mask and stencil are shared by all periods; each period is fitted on its own and a pooled fit
+    # minimizes the sum of the period objectives
+    period_fits = [] # Per-period and pooled estimates
     
-    # Initialize the dataframe that will hold values of the brute force
-    a_list = np.linspace(a_lower, a_upper, 10)
-    b_list = np.linspace(b_lower, b_upper, 5)
-    fst_results = pd.DataFrame(data={'a'        : np.repeat(a_list, len(b_list)).astype(np.float32),
-                                     'b'        : np.tile(b_list, len(a_list)).astype(np.float32),
-                                     'estimate' : np.full(len(a_list)*len(b_list), np.nan, dtype=np.float64)
-                    }
-                )
     
-    # Run brute force to calculate optimization per grid point
-    i = 0
-    for a in a_list:
-        for b in b_list:
-            fst_results.loc[(fst_results['a'] == a) & (fst_results['b'] == b),
-                            'estimate'] = pdm.pop_min_function((a, b), *params)
-            print('{}th iteratin done'.format(i))
-            i+=1
+    # Read indices of points that fall within the state boundary, once for all periods
+    within_indices = pdm.read_within_indices(point_indices)
+    window         = pdm.RasterWindow(mask_raster, within_indices, neighborhood_dis)
+    within_indices = window.within_indices
+    points_mask    = window.read(mask_raster)
+    shape          = window.shape
     
-
-    # Save the current optimization file
-    brute_force_csv = os.path.join(calibration_outputs, 'initial_values.csv')
-    fst_results.to_csv(brute_force_csv)
+    # Calculate a distance matrix that serves as a template
+    dist_matrix = pdm.stencil_generator(shape, window.resolution, neighborhood_dis, stencil_cache)
+    
+    # Values of alpha and beta evaluated by the brute force
+    a_list = np.linspace(-1.0, 1.0, 10)
+    b_list = np.linspace(0, 1, 5)
+    
+    
+    period_params     = []
+    period_objectives = []
+    grid_estimates    = 0
+    try:
+        for pop_start_grid, pop_end_grid in periods:
+            years  = [[int(s) for s in os.path.basename(grid)[:-4].split("_") if s.isdigit()][0] 
+                      for grid in (pop_start_grid, pop_end_grid)]
+            period = '{}-{}'.format(*years)
+            
+            # Only the population grids and the engine built on the first one differ between periods
+            population_1st = window.read(pop_start_grid)
+            population_2nd = window.read(pop_end_grid)
+            engine         = pdm.suitability_engine(suitability_engine, population_1st, dist_matrix, within_indices,
+                                                    shape, stencil_cache, kernel_tolerance)
+            params         = (population_1st, population_2nd, points_mask, dist_matrix, within_indices, shape, engine)
+            period_params.append(params)
+            objective      = pdm.ObjectiveCache(os.path.join(calibration_outputs, 'objective_cache.csv'), params)
+            
+            # Run brute force, then use the point with the minimum value as an initial guess
+            fst_results     = objective.grid_search(a_list, b_list, *params)
+            grid_estimates += fst_results['estimate'].values
+            (a0, b0)        = fst_results.loc[fst_results['estimate'].idxmin(), ['a', 'b']] 
+            
+            parameters = scipy.optimize.minimize(objective, x0 = (a0, b0), 
+                                                 args = params, method = 'SLSQP',
+                                                 options = {'disp' : True, 'eps': 0.01, 'ftol': 0.01},
+                                                 bounds = ((-2.0, 2.0), (-0.5, 2.0)))
+            period_fits.append({'period': period, 'alpha': parameters['x'][0], 'beta': parameters['x'][1], 
+                                'estimate': parameters['fun']})
+            
+            period_objectives.append(objective)
         
-
-    # Use the point with the minimum value as an initial guess for the second optimizer
-    (a0, b0) = fst_results.loc[fst_results['estimate'].idxmin(), ['a', 'b']] 
+        
+        # Pooled fit over all periods, starting from the brute force point with the lowest total
+        def pooled_objective(z):
+            return sum(objective(z, *params) for objective, params in zip(period_objectives, period_params))
+        
+        (a0, b0)   = fst_results.loc[np.argmin(grid_estimates), ['a', 'b']]
+        parameters = scipy.optimize.minimize(pooled_objective, x0 = (a0, b0), method = 'SLSQP',
+                                             options = {'disp' : True, 'eps': 0.01, 'ftol': 0.01},
+                                             bounds = ((-2.0, 2.0), (-0.5, 2.0)))
+        period_fits.append({'period': 'pooled', 'alpha': parameters['x'][0], 'beta': parameters['x'][1],
+                            'estimate': parameters['fun']})
+        
+        for objective in period_objectives:
+            print(objective.report())
+    finally:
+        
+        # The engines of all periods are released even if a fit fails
+        for params in period_params:
+            params[6].close()
     
     
-    # Final optimization
-    parameters = scipy.optimize.minimize(pdm.pop_min_function, x0 = (a0, b0), 
-                                            args = params, method = 'SLSQP',
-                                            options = {'disp' : True, 'eps': 0.01, 'ftol': 0.01},
-                                            bounds = ((-2.0, 2.0), (-0.5, 2.0)))
+    # Per-period and pooled estimates, and the pooled ones as the projection parameters
+    period_fits = pd.DataFrame(period_fits)
+    print(period_fits.to_string(index=False))
+    period_fits.to_csv(os.path.join(calibration_outputs, 'parameters_periods.csv'))
     
-
-    # Write the parameters to the designated csv file
     parameters_dict        = pd.DataFrame({'alpha':[parameters['x'][0]] * 9, 'beta':[parameters['x'][1]] * 9,
                                             'scenario':['SSP2'] * 9, 'year': list(range(2020, 2110, 10))})
     output_parameters_file = os.path.join(calibration_outputs, 'parameters_SSP2.csv')
@@ -150,7 +311,8 @@ def calibration(pop_fst_year, pop_snd_year, mask_raster, point_indices, point_co
 
 #=========================================================================================       
 def pop_projection(pop_start_year, mask_raster, aggregate_projections, point_indices,
-                   params_file, point_coors, neighborhood_dis, scenario):
+                   params_file, neighborhood_dis, scenario, suitability_engine, kernel_tolerance=None,
+                   projection_outputs=projection_outputs):
 
     
     # Define local variables
@@ -158,32 +320,25 @@ def pop_projection(pop_start_year, mask_raster, aggregate_projections, point_ind
     proj_year = cur_year + 10
     borough_name = pop_start_year.split("/")[-2]
     
-    # Population array in the first year
-    population_1st_array = pdm.raster_to_array(pop_start_year) 
-
-    # Mask array
-    points_mask = pdm.raster_to_array(mask_raster)
+    # Read indices of points that fall within the state boundary
+    within_indices = pdm.read_within_indices(point_indices)
     
-    # All indices
-    all_indices = pdm.all_index_retriever(pop_start_year, ["row", "column"])
+    # Rasters are only read over the window of the within-boundary cells and their neighborhood
+    window         = pdm.RasterWindow(mask_raster, within_indices, neighborhood_dis)
+    within_indices = window.within_indices
     
+    # Population array in the first year
+    population_1st_array = window.read(pop_start_year) 
+    shape                = window.shape
+    resolution           = window.resolution
 
-    # Read indices of points that fall within the state boundary
-    within_indices = pyreadr.read_r(point_indices)
-    within_indices = pd.DataFrame(list(within_indices.values())[0])
-    within_indices = list(within_indices.loc[:, 'index'].astype(int).values)
+    # Mask array
+    points_mask = window.read(mask_raster)
         
 
     # Calculate a distance matrix that serves as a template
     cut_off_meters = neighborhood_dis
-    dist_matrix    = pdm.dist_matrix_calculator(within_indices[0], cut_off_meters, all_indices, point_coors)
-    
-
-    # Number of columns of population grid required to derive linear indices  
-    ind_diffs = dist_matrix["ind_diff"].values
-    
-    # Distances between current point and its close points
-    ini_dist = dist_matrix["dis"].values/1000.0
+    dist_matrix    = pdm.stencil_generator(shape, resolution, cut_off_meters, stencil_cache)
 
 
     # Derive aggregate population at time 1
@@ -212,105 +367,424 @@ def pop_projection(pop_start_year, mask_raster, aggregate_projections, point_ind
     b = calib_params.loc[(calib_params.year == cur_year) & (calib_params.scenario == scenario), 'beta'].iloc[0]
 
 
-    # Distance elements 
-    dist                 = -b * ini_dist
-    exp_xx_inv_beta_dist = np.exp(dist)
+    # Exract only the necessary mask values that fall within the state boundary
+    points_mask = pdm.raster_array_modifier(points_mask, within_indices)  
+    points_mask = pdm.mask_modifier(points_mask, pop_first_year, negative_mod)
+
+
+    # Allocate the population change, making sure that no cell has less than 0 individuals
+    engine = pdm.suitability_engine(suitability_engine, population_1st_array, dist_matrix, within_indices, shape,
+                                    stencil_cache, kernel_tolerance)
+    try:
+        pop_estimates, redistribution = pdm.pop_estimator(engine, a, b, points_mask, pop_first_year,
+                                                          pop_change, negative_mod)
+    finally:
+        engine.close()
+    if negative_mod:
+        print("cells clipped to zero: {clipped_cells}, population redistributed: {deficit}".format(
+              **redistribution))
     
+    
+    # Write the final array to the output 
+    output_raster = os.path.join(projection_outputs,
+                                  'pop_grid_' + scenario + '_' + str(proj_year) + '.tif')
+    print("output downscaled data: " + output_raster)
+    window.write(output_raster, pop_estimates)
+
 
-    # Initialize the parallelization
-    pool = Pool(processes = multiprocessing.cpu_count() - 1)
+
+
+#=========================================================================================       
+def projection_static_inputs(mask_raster, point_indices, neighborhood_dis):
     
-    # Provide the inputs for the parallelized function
-    parallel_elements = [(i, ind_diffs, population_1st_array, a, exp_xx_inv_beta_dist) for i in within_indices]
+    # Inputs of the projection that do not change across decades or scenarios of a borough
+    static_inputs = {}
     
-    # Derive suitability estimates
-    suitability_estimates = pool.map(pdm.suitability_estimator, parallel_elements)
+    # Read indices of points that fall within the state boundary
+    within_indices = pdm.read_within_indices(point_indices)
+    window         = pdm.RasterWindow(mask_raster, within_indices, neighborhood_dis)
+    static_inputs['window'] = window
     
-
-    # Change suitability estimates to a numpy array
-    suitability_estimates = np.array(suitability_estimates)
+    # Mask array, which also provides the values outside the boundary in the outputs
+    static_inputs['mask_array'] = window.read(mask_raster)
     
+    # Calculate a distance matrix that serves as a template
+    static_inputs['dist_matrix'] = pdm.stencil_generator(window.shape, window.resolution, neighborhood_dis,
+                                                         stencil_cache)
+    
+    return static_inputs
 
-    # Exract only the necessary mask values that fall within the state boundary
-    points_mask = pdm.raster_array_modifier(points_mask, within_indices)  
-    points_mask[np.isnan(points_mask)] = 0
 
 
-    # In case of population decline, suitability estimates are reciprocated 
-    if negative_mod:
+
+#=========================================================================================       
+def pop_projection_series(first_pop_grid, mask_raster, aggregate_projections, point_indices,
+                          params_file, neighborhood_dis, scenario, suitability_engine, years,
+                          kernel_tolerance=None, static_inputs=None, output_stack=False,
+                          suitability_cache=None, projection_outputs=projection_outputs):
+    
+    # Same projection as calling pop_projection for every decade, but the static inputs are read once
+    # (or shared by the caller), the population of each decade is carried in memory to the next and
+    # the outputs are written by a background thread
+    borough_name = first_pop_grid.split("/")[-2]
+    
+    if static_inputs is None:
+        static_inputs = projection_static_inputs(mask_raster, point_indices, neighborhood_dis)
+    
+    window         = static_inputs['window']
+    mask_array     = static_inputs['mask_array']
+    dist_matrix    = static_inputs['dist_matrix']
+    within_indices = window.within_indices
+    shape          = window.shape
+    points_mask    = pdm.raster_array_modifier(mask_array, within_indices)
+    
+    # Aggregate projections and calibration parameters
+    pop_t2_df    = pd.read_csv(aggregate_projections)
+    calib_params = pd.read_csv(params_file)
+    
+    
+    # Population array in the first year
+    population_1st_array = window.read(first_pop_grid)
+    
+    # Outputs go to a GeoTIFF per decade, or to the decade bands of a single time series stack
+    if output_stack:
+        stack_raster = os.path.join(projection_outputs, 'pop_grid_' + scenario + '.tif')
+        target       = pdm.RasterStack(window, stack_raster, [year + 10 for year in years])
+        print("output downscaled data: " + stack_raster)
+    else:
+        target = window
+    
+    # Engines that can take a new population in place (the shared pool) are built once for all decades
+    engine = None
+    
+    try:
+        with pdm.RasterWriter(target) as writer:
+            for cur_year in years:
+                proj_year = cur_year + 10
+                
+                # Derive aggregate population at time 1
+                pop_first_year = pdm.raster_array_modifier(population_1st_array, within_indices)
+                pop_t1         = pop_first_year.sum()
+                
+                # Extract aggregate population at time 2
+                pop_t2 = pop_t2_df.loc[(pop_t2_df.Year == proj_year) & (pop_t2_df.Region == borough_name),
+                                       "Population"].iloc[0]
+                
+                # Population change between years 1 and 2
+                pop_change   = pop_t2 - pop_t1
+                negative_mod = 1 if pop_change < 0 else 0
+                
+                # Extract the alpha and beta values from the calibration files
+                year_params = calib_params.loc[(calib_params.year == cur_year) & (calib_params.scenario == scenario)]
+                a = year_params['alpha'].iloc[0]
+                b = year_params['beta'].iloc[0]
+                
+                
+                # Allocate the population change, making sure that no cell has less than 0 individuals
+                year_mask = pdm.mask_modifier(points_mask.copy(), pop_first_year, negative_mod)
+                
+                # Only the first decade starts from a grid that does not depend on the mask, so it is the only
+                # one whose suitability is cached
+                if suitability_cache is not None and cur_year == years[0]:
+                    suitability_estimates = suitability_cache.evaluate(population_1st_array, dist_matrix,
+                                                                       within_indices, shape, a, b)
+                    pop_estimates, redistribution = pdm.pop_allocator(suitability_estimates, year_mask,
+                                                                      pop_first_year, pop_change, negative_mod)
+                else:
+                    if hasattr(engine, 'publish_population'):
+                        engine.publish_population(population_1st_array)
+                    else:
+                        if engine is not None:
+                            engine.close()
+                        engine = pdm.suitability_engine(suitability_engine, population_1st_array, dist_matrix,
+                                                        within_indices, shape, stencil_cache, kernel_tolerance)
+                    pop_estimates, redistribution = pdm.pop_estimator(engine, a, b, year_mask, pop_first_year,
+                                                                      pop_change, negative_mod)
+                if negative_mod:
+                    print("cells clipped to zero: {clipped_cells}, population redistributed: {deficit}".format(
+                          **redistribution))
+                
+                
+                # Hand the output to the writer and carry the grid, as it would be read back, to the next decade
+                if output_stack:
+                    writer.submit(proj_year, pop_estimates)
+                else:
+                    output_raster = os.path.join(projection_outputs,
+                                                 'pop_grid_' + scenario + '_' + str(proj_year) + '.tif')
+                    print("output downscaled data: " + output_raster)
+                    writer.submit(output_raster, pop_estimates)
+                
+                population_1st_array                 = mask_array.astype(window.profile['dtype'])
+                population_1st_array[within_indices] = pop_estimates
+    finally:
         
-        # find those whose mask is 0 but have population, they should decline anyway 
-        mask_zero    = np.where(points_mask == 0)[0]
-        pop_non_zero = np.where(pop_first_year != 0)[0]
+        # The engine (and its pool and shared memory) and the stack are released even if a decade fails
+        if engine is not None:
+            engine.close()
         
-        # Those cells with mask value of zero and population are the intersection of the two above arrays
-        pop_mask = np.intersect1d(mask_zero, pop_non_zero, assume_unique=True)
+        if output_stack:
+            target.close()
+
+
+
+
+#=========================================================================================       
+def pop_reprojection(old_mask_raster, new_mask_raster, first_pop_grid, aggregate_projections, point_indices,
+                     params_file, neighborhood_dis, scenario, suitability_engine, years, kernel_tolerance=None,
+                     projection_outputs=projection_outputs):
+    
+    # Re-run the projection with a revised mask. This is a cached rerun rather than an incremental update:
+    # suitability does not depend on the mask, so the first decade only redoes the allocation, using the
+    # estimates cached by a projection made with cache_suitability enabled or by an earlier reprojection
+    # (the first one writes them when missing). From the second decade on the starting grid depends on
+    # the mask, so suitability is derived in full over the whole window and a one-neighborhood edit still
+    # costs about 7/8 of a full run. The changed cells are only used to skip the rerun when the mask is
+    # unchanged
+    static_inputs = projection_static_inputs(new_mask_raster, point_indices, neighborhood_dis)
+    
+    changed_cells = pdm.mask_difference(static_inputs['window'], old_mask_raster, new_mask_raster)
+    print("mask cells changed: " + str(len(changed_cells)))
+    if len(changed_cells) == 0:
+        return
+    
+    cache = pdm.SuitabilityCache(suitability_cache_dir, suitability_engine, stencil_cache, kernel_tolerance)
+    pop_projection_series(first_pop_grid, new_mask_raster, aggregate_projections, point_indices,
+                          params_file, neighborhood_dis, scenario, suitability_engine, years,
+                          kernel_tolerance, static_inputs, suitability_cache=cache,
+                          projection_outputs=projection_outputs)
+    print(cache.report())
+
+
+
+
+#=========================================================================================       
+def pop_projection_ensemble(first_pop_grid, mask_raster, aggregate_projections, point_indices,
+                            params_file, neighborhood_dis, scenario, years, members=100, draws=None,
+                            alpha_sd=0.05, beta_sd=0.05, quantiles=(0.05, 0.5, 0.95), member_chunk=16,
+                            reservoir_size=100, seed=None, static_inputs=None,
+                            projection_outputs=projection_outputs):
+    
+    # Monte Carlo ensemble over alpha and beta. Every member follows its own trajectory across the
+    # decades, either with fixed (alpha, beta) draws or with perturbations of the calibrated values.
+    # Members are projected in chunks through a batched FFT and only per-cell summaries are kept
+    borough_name = first_pop_grid.split("/")[-2]
+    rng          = np.random.default_rng(seed)
+    
+    if static_inputs is None:
+        static_inputs = projection_static_inputs(mask_raster, point_indices, neighborhood_dis)
+    
+    window         = static_inputs['window']
+    mask_array     = static_inputs['mask_array']
+    dist_matrix    = static_inputs['dist_matrix']
+    within_indices = window.within_indices
+    shape          = window.shape
+    points_mask    = pdm.raster_array_modifier(mask_array, within_indices)
+    
+    # Aggregate population at time 2 and calibrated parameters of every decade
+    pop_t2_df    = pd.read_csv(aggregate_projections)
+    calib_params = pd.read_csv(params_file)
+    pop_t2       = {}
+    year_params  = {}
+    for cur_year in years:
+        pop_t2[cur_year]      = pop_t2_df.loc[(pop_t2_df.Year == cur_year + 10) & 
+                                              (pop_t2_df.Region == borough_name), "Population"].iloc[0]
+        year_params[cur_year] = calib_params.loc[(calib_params.year == cur_year) & 
+                                                 (calib_params.scenario == scenario), ['alpha', 'beta']].values[0]
+    
+    # Member draws of (alpha, beta), or perturbations added to the calibrated values of each decade
+    if draws is not None:
+        draws   = np.asarray(draws, dtype=np.float64)
+        members = len(draws)
+    else:
+        perturbations = rng.normal(0, (alpha_sd, beta_sd), (members, 2))
+    
+    statistics = {cur_year: pdm.StreamingStatistics(len(within_indices), reservoir_size, seed)
+                  for cur_year in years}
+    
+    
+    # Population array in the first year
+    first_population = window.read(first_pop_grid)
+    
+    for start in range(0, members, member_chunk):
+        chunk = range(start, min(start + member_chunk, members))
         
-        # Change the mask value of the above cells to 1 so that they also lose population
-        points_mask[pop_mask] = points_mask.mean()
+        # The members of the chunk start from the same grid
+        populations = np.tile(first_population, (len(chunk), 1))
         
-        # Adjust suitability values by applying mask values
-        suitability_estimates = points_mask * suitability_estimates
+        for cur_year in years:
+            if draws is not None:
+                params = draws[chunk.start:chunk.stop]
+            else:
+                params = year_params[cur_year] + perturbations[chunk.start:chunk.stop]
+            
+            # Members share the NaN cells of their grids, so one engine evaluates all of them
+            engine      = pdm.GridSuitability(populations[0], dist_matrix, within_indices, shape)
+            suitability = engine.evaluate_members(populations, params[:, 0], params[:, 1])
+            
+            estimates = np.empty((len(chunk), len(within_indices)))
+            for k in range(len(chunk)):
+                
+                # Population change between years 1 and 2
+                pop_first_year = pdm.raster_array_modifier(populations[k], within_indices)
+                pop_change     = pop_t2[cur_year] - pop_first_year.sum()
+                negative_mod   = 1 if pop_change < 0 else 0
+                
+                # Allocate the population change, making sure that no cell has less than 0 individuals
+                member_mask     = pdm.mask_modifier(points_mask.copy(), pop_first_year, negative_mod)
+                estimates[k], _ = pdm.pop_allocator(suitability[k], member_mask, pop_first_year, 
+                                                    pop_change, negative_mod)
+            
+            statistics[cur_year].update(estimates)
+            
+            # Carry the grids, as they would be read back, to the next decade
+            populations                    = np.tile(mask_array.astype(window.profile['dtype']), (len(chunk), 1))
+            populations[:, within_indices] = estimates
+    
+    
+    # Mean, standard deviation and quantiles of each decade as the bands of one GeoTIFF, with NaN
+    # (nodata) outside the boundary
+    band_names = ['mean', 'std'] + ['q' + str(q) for q in quantiles]
+    for cur_year in years:
+        output_raster = os.path.join(projection_outputs,
+                                     'pop_ensemble_' + scenario + '_' + str(cur_year + 10) + '.tif')
+        print("output downscaled ensemble: " + output_raster)
         
-        # Inverse current mask values for a better reflection of population decline
-        suitability_estimates[suitability_estimates != 0] = 1.0/suitability_estimates[suitability_estimates != 0]
-    
-    else:
-        # Adjust suitability values by applying its mask values
-        suitability_estimates = points_mask * suitability_estimates
+        stack = pdm.RasterStack(window, output_raster, band_names, nodata=np.nan)
+        stack.write('mean', statistics[cur_year].mean)
+        stack.write('std', np.sqrt(statistics[cur_year].variance()))
+        for q, values in zip(quantiles, statistics[cur_year].quantiles(quantiles)):
+            stack.write('q' + str(q), values)
+        stack.close()
 
-    # Total suitability for the whole area, which is the summation of all individual suitability values
-    tot_suitability = suitability_estimates.sum()
 
-    # Final population estimates if nagative mode is off
-    pop_estimates = suitability_estimates/tot_suitability * pop_change + pop_first_year
-    
 
-    # Adjust the projection so that no cell can have less than 0 individuals.    
-    if negative_mod:
-        # To make sure that there is no negative population
-        while any(pop < 0 for pop in pop_estimates):
-            new_tot_suitability = 0 # Total suitability calculated over points with positive population
-            extra_pop_mod = 0 # For adjusting negative population values
-            
-            # Treating negative population values
-            extra_pop_mod = abs(pop_estimates[pop_estimates < 0].sum())
-            pop_estimates[pop_estimates < 0] = 0
 
-            # Calculate the new total suitability value based on points with positive projected population                
-            new_tot_suitability = suitability_estimates[pop_estimates > 0].sum()       
+#=========================================================================================       
+def pop_projection_city(first_pop_grid, mask_raster, borough_raster, borough_codes, aggregate_projections,
+                        neighborhood_dis, scenario, years, tile_size=256):
+    
+    # Projection on a single city-wide grid, so that neighbors across borough lines are counted. The
+    # suitability is derived tile by tile in parallel, and the population change is allocated within
+    # each borough using its own parameters and aggregate projection
+    city_outputs = os.path.join('.', 'outputs', 'population_downscaling', 'projection', scenario, 'NYC')
+    os.makedirs(city_outputs, exist_ok=True)
+    
+    
+    # Within-boundary cells of all boroughs, grouped by tile
+    label_array    = pdm.raster_to_array(borough_raster)
+    shape          = pdm.raster_shape(borough_raster)
+    resolution     = pdm.raster_resolution(borough_raster)
+    tiles          = pdm.city_tiles(label_array, shape, tile_size)
+    tile_labels    = [label_array[tile_indices] for tile_indices in tiles]
+    within_indices = np.concatenate(tiles)
+    labels         = label_array[within_indices]
+    
+    # Mask values of the within-boundary cells
+    window      = pdm.RasterWindow(mask_raster, within_indices)
+    points_mask = pdm.raster_array_modifier(window.read(mask_raster), window.within_indices)
+    
+    # Calculate a distance matrix that serves as a template for every tile
+    dist_matrix = pdm.stencil_generator(shape, resolution, neighborhood_dis, stencil_cache)
+    
+    # Boroughs present on the grid, with their aggregate projections and calibration parameters
+    borough_codes = {label: name for label, name in borough_codes.items() if (labels == label).any()}
+    pop_t2_df     = pd.read_csv(aggregate_projections)
+    calib_params  = {label: pd.read_csv(os.path.join(projection_inputs_path, name, 'parameters_' + scenario + '.csv'))
+                     for label, name in borough_codes.items()}
+    
+    
+    pop_start_year = first_pop_grid
+    for cur_year in years:
+        proj_year = cur_year + 10
+        
+        # Population in the first year
+        pop_first_year = pdm.raster_array_modifier(window.read(pop_start_year), window.within_indices)
+        
+        # Suitability of all the cells, tile by tile, with the alpha and beta of their borough
+        borough_params = {}
+        for label, params in calib_params.items():
+            year_params           = params.loc[(params.year == cur_year) & (params.scenario == scenario)]
+            borough_params[label] = (year_params['alpha'].iloc[0], year_params['beta'].iloc[0])
+        
+        suitability_estimates = pdm.city_suitability(pop_start_year, tiles, tile_labels, dist_matrix,
+                                                     neighborhood_dis, borough_params)
+        
+        # Allocate the population change of each borough to its own cells
+        pop_estimates = np.zeros(len(within_indices))
+        for label, name in borough_codes.items():
+            cells        = labels == label
+            pop_t2       = pop_t2_df.loc[(pop_t2_df.Year == proj_year) & (pop_t2_df.Region == name),
+                                         "Population"].iloc[0]
+            pop_change   = pop_t2 - pop_first_year[cells].sum()
+            negative_mod = 1 if pop_change < 0 else 0
             
-            # Adjust non-negative population values to maintain the total aggregated population 
-            pop_estimates[pop_estimates > 0] = pop_estimates[pop_estimates > 0] - \
-            (suitability_estimates[pop_estimates > 0]/new_tot_suitability) * extra_pop_mod
+            borough_mask = pdm.mask_modifier(points_mask[cells].copy(), pop_first_year[cells], negative_mod)
+            pop_estimates[cells], redistribution = pdm.pop_allocator(suitability_estimates[cells], borough_mask,
+                                                                     pop_first_year[cells], pop_change,
+                                                                     negative_mod)
+            if negative_mod:
+                print(name + " cells clipped to zero: {clipped_cells}, population redistributed: {deficit}".format(
+                      **redistribution))
         
-    
-    
-    # Write the final array to the output 
-    output_raster = os.path.join(projection_outputs,
-                                  'pop_grid_' + scenario + '_' + str(proj_year) + '.tif')
-    print("output downscaled data: " + output_raster)
-    pdm.array_to_raster(mask_raster, pop_estimates, within_indices, output_raster)
+        
+        # Tiles of the next decade read their halo from this output
+        output_raster = os.path.join(city_outputs, 'pop_grid_' + scenario + '_' + str(proj_year) + '.tif')
+        print("output downscaled data: " + output_raster)
+        window.write(output_raster, pop_estimates)
+        pop_start_year = output_raster
 
 
 
 
 #=========================================================================================
 
-# The calibration component
-calibration(pop_fst_year, pop_snd_year, mask_raster, point_indices, point_coors, neighborhood_dis)
-
- 
-# The projection component  
-for year in range(2020, 2100, 10):
-    if year == 2020:
-        pop_start_year = first_pop_grid
+if __name__ == '__main__':
+    
+    # Calibration and projection outputs
+    for output_folder in (calibration_outputs, projection_outputs):
+        try:
+            os.makedirs(output_folder)
+        except:
+            print('The folder already exists!')
+    
+    # Serve project(total, alpha, beta, start_grid) queries on the borough inputs until shutdown
+    if serve_session:
+        session = pdm.ProjectionSession(mask_raster, point_indices, neighborhood_dis, suitability_engine,
+                                        first_pop_grid, stencil_cache, kernel_tolerance)
+        pdm.serve_projection_session(session, session_address, session_authkey)
+        sys.exit()
+
+    # The calibration component
+    if len(calibration_pairs) > 1:
+        calibration_periods(calibration_pairs, mask_raster, point_indices, neighborhood_dis,
+                            suitability_engine, kernel_tolerance)
     else:
-        pop_start_year = os.path.join(projection_outputs,
-                                'pop_grid_' + scenario + '_' + str(year) + '.tif')
+        calibration(pop_fst_year, pop_snd_year, mask_raster, point_indices, neighborhood_dis,
+                    suitability_engine, pyramid_factor, kernel_tolerance)
 
-    pop_projection(pop_start_year, mask_raster, aggregate_projections, point_indices,
-                    params_file, point_coors, neighborhood_dis, scenario)
+ 
+    # The projection component, chaining the decades from 2020 to 2090 in memory
+    pop_projection_series(first_pop_grid, mask_raster, aggregate_projections, point_indices,
+                          params_file, neighborhood_dis, scenario, suitability_engine,
+                          range(2020, 2100, 10), kernel_tolerance, output_stack=output_stack,
+                          suitability_cache=pdm.SuitabilityCache(suitability_cache_dir, suitability_engine,
+                                                                 stencil_cache, kernel_tolerance)
+                                            if cache_suitability else None)
+    
+    
+    # Uncertainty bands of the projection
+    if ensemble_members > 0:
+        pop_projection_ensemble(first_pop_grid, mask_raster, aggregate_projections, point_indices,
+                                params_file, neighborhood_dis, scenario, range(2020, 2100, 10),
+                                members=ensemble_members)
+    
+    
+    # The city-wide projection of all boroughs
+    if city_wide:
+        pop_projection_city(os.path.join(city_inputs_path, 'pop_grid_2020.tif'),
+                            os.path.join(city_inputs_path, 'mask_raster.tif'), borough_raster, borough_codes,
+                            aggregate_projections, neighborhood_dis, scenario, range(2020, 2100, 10),
+                            city_tile_size)
 
 
    
@@ -5,13 +5,40 @@ A package that contains necessary functions for population downscaling.
 @author: Hamidreza Zoraghein
 """
 #======================================================================================
+import os
+import contextlib
+import hashlib
+import queue
+import threading
+import time
+from multiprocessing.connection import Listener, AuthenticationError
 import numpy as np
 import pandas as pd
 import rasterio
-from scipy.spatial import cKDTree
+from rasterio.windows import Window
+import scipy.fft
+import scipy.sparse
 import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory
 from pathos.multiprocessing import ProcessingPool as Pool
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+
+# Number of worker processes (or FFT threads) used by the parallel engines
+max_workers = max(multiprocessing.cpu_count() - 1, 1)
+
+# Arrays published to the workers of SharedSuitability, attached once per worker process
+_shared_arrays = {}
+
+# Stencil and calibration parameters of the city-wide tile workers, set once per worker process
+_tile_inputs = {}
+
 
 
 def raster_to_array(raster):
@@ -22,46 +49,265 @@ def raster_to_array(raster):
         final_array = band.flatten()
     
     return(final_array)
+
+
+
+def raster_shape(raster):
+    
+    # Number of rows and columns of the input raster
+    with rasterio.open(raster) as src_raster:
+        shape = (src_raster.height, src_raster.width)
+    
+    return(shape)
+
+
+
+def raster_resolution(raster):
+    
+    # Cell width and height of the input raster in map units (meters)
+    with rasterio.open(raster) as src_raster:
+        resolution = src_raster.res
+    
+    return(resolution)
+    
+
+
+def within_indices_converter(rds_file, npy_file=None):
+    
+    # One-time conversion of the within-boundary indices from R's .rds to an int32 .npy store
+    import pyreadr
+    
+    if npy_file is None:
+        npy_file = os.path.splitext(rds_file)[0] + ".npy"
+    
+    within_indices = pyreadr.read_r(rds_file)
+    within_indices = pd.DataFrame(list(within_indices.values())[0])
+    within_indices = within_indices.loc[:, "index"].values.astype(np.int32)
     
+    np.save(npy_file, within_indices)
+    
+    return(npy_file)
+
+
+
+def read_within_indices(point_indices):
+    
+    # The .npy store next to an .rds file is created on first use and memory-mapped afterwards
+    if point_indices.endswith(".rds"):
+        npy_file = os.path.splitext(point_indices)[0] + ".npy"
+        if not os.path.exists(npy_file) or os.path.getmtime(npy_file) < os.path.getmtime(point_indices):
+            within_indices_converter(point_indices, npy_file)
+        point_indices = npy_file
+    
+    return np.load(point_indices, mmap_mode="r")
+
 
 
 def array_to_raster(input_raster, input_array, within_indices, output_raster):
     
-    with rasterio.open(input_raster) as src_raster:
-        band        = src_raster.read(1)
-        src_profile = src_raster.profile
-        row_count   = band.shape[0]
-        col_count   = band.shape[1]
-        flat_array  = band.flatten()
+    # Cells outside the within-boundary indices keep the values of the input raster
+    RasterWindow(input_raster, within_indices).write(output_raster, input_array)
+
+
+
+class RasterWindow:
+    """
+    Raster access layer for grids that share the grid of a template raster. Reads
+    are limited to the bounding window of the within-boundary cells, padded by a
+    halo of the neighborhood distance, and go through block-aligned tiles. Outputs
+    keep the template extent and are written tile by tile with the profile cached
+    at load time, so peak memory scales with the window and not with the raster.
+    """
+    
+    def __init__(self, raster, within_indices, halo_meters=0):
+        
+        with rasterio.open(raster) as src_raster:
+            self.template   = raster
+            self.profile    = src_raster.profile.copy()
+            self.full_shape = (src_raster.height, src_raster.width)
+            self.resolution = src_raster.res
+        
+        # Rows and columns of the within-boundary cells on the full grid
+        within_indices   = np.asarray(within_indices, dtype=np.int64)
+        self.within_rows = within_indices // self.full_shape[1]
+        self.within_cols = within_indices %  self.full_shape[1]
+        
+        # Bounding window of the within-boundary cells plus a halo of neighbors, clipped to the raster
+        halo_rows = int((halo_meters + 1) // self.resolution[1]) if halo_meters else 0
+        halo_cols = int((halo_meters + 1) // self.resolution[0]) if halo_meters else 0
+        row_off   = max(self.within_rows.min() - halo_rows, 0)
+        col_off   = max(self.within_cols.min() - halo_cols, 0)
+        row_end   = min(self.within_rows.max() + halo_rows + 1, self.full_shape[0])
+        col_end   = min(self.within_cols.max() + halo_cols + 1, self.full_shape[1])
+        
+        self.window = Window(int(col_off), int(row_off), int(col_end - col_off), int(row_end - row_off))
+        self.shape  = (self.window.height, self.window.width)
+        
+        # Linear indices of the within-boundary cells inside the window
+        self.within_indices = (self.within_rows - row_off) * self.shape[1] + (self.within_cols - col_off)
+    
     
-    # Replace initial array values with those from the input array 
-    flat_array[within_indices] = input_array
+    def read(self, raster):
+        
+        with rasterio.open(raster) as src_raster:
+            window_array = np.empty(self.shape, dtype=src_raster.dtypes[0])
+            
+            # Read the window through the blocks of the raster that overlap it
+            for _, block in src_raster.block_windows(1):
+                if not rasterio.windows.intersect(block, self.window):
+                    continue
+                tile    = block.intersection(self.window)
+                row_off = tile.row_off - self.window.row_off
+                col_off = tile.col_off - self.window.col_off
+                window_array[row_off:row_off + tile.height, 
+                             col_off:col_off + tile.width] = src_raster.read(1, window=tile)
+        
+        return window_array.flatten()
     
     
-    array = flat_array.reshape(row_count, col_count)
+    def write(self, output_raster, input_array, fill_raster=None):
+        
+        with rasterio.open(output_raster, "w", **self.profile) as dst:
+            self.write_band(dst, 1, input_array, fill_raster)
     
-    with rasterio.open(output_raster, "w", **src_profile) as dst:
-        dst.write_band(1, array)
     
+    def write_band(self, dst, band, input_array, fill_raster=None, fill_value=None):
+        
+        # Values outside the within-boundary cells are copied from the fill (by default template) raster,
+        # or set to the fill value when one is given
+        if fill_raster is None:
+            fill_raster = self.template
+        
+        with (rasterio.open(fill_raster) if fill_value is None else contextlib.nullcontext()) as src_raster:
+            
+            # Group the within-boundary cells by the output block that contains them
+            block_shape = dst.block_shapes[band - 1]
+            block_cols  = -(-self.full_shape[1] // block_shape[1])
+            block_ids   = (self.within_rows // block_shape[0]) * block_cols + self.within_cols // block_shape[1]
+            order       = np.argsort(block_ids, kind="stable")
+            sorted_ids  = block_ids[order]
+            
+            for (block_row, block_col), block in dst.block_windows(band):
+                if fill_value is None:
+                    tile = src_raster.read(1, window=block)
+                else:
+                    tile = np.full((block.height, block.width), fill_value, dtype=dst.dtypes[band - 1])
+                
+                # Replace the fill values with those from the input array
+                block_id   = block_row * block_cols + block_col
+                start, end = np.searchsorted(sorted_ids, [block_id, block_id + 1])
+                cells      = order[start:end]
+                tile[self.within_rows[cells] - block.row_off, 
+                     self.within_cols[cells] - block.col_off] = input_array[cells]
+                
+                dst.write(tile, band, window=block)
 
 
-def all_index_retriever(raster, columns):
+
+class RasterStack:
+    """
+    Time series output: one tiled, compressed GeoTIFF on the template grid with
+    a band per decade. Bands are written with RasterWindow.write_band and named
+    after their decade, so reading the series of a neighborhood is a single open
+    and a few small tile reads instead of one full file per decade. With a nodata
+    value, cells outside the boundary are set to it rather than copied from the
+    template raster.
+    """
     
-    # Read the input raster before conveting it to an array
-    with rasterio.open(raster) as src_raster:
-        array = src_raster.read(1)
+    def __init__(self, window, output_raster, band_names, block_size=256, compress="deflate", nodata=None):
+        
+        self.window     = window
+        self.band_names = [str(name) for name in band_names]
+        self.nodata     = nodata
+        
+        # Tiles have to be multiples of 16, and no larger than needed for small grids
+        block_size = min(block_size, max(16, -(-max(window.full_shape) // 16) * 16))
+        profile    = window.profile.copy()
+        profile.update(count=len(self.band_names), tiled=True, blockxsize=block_size, blockysize=block_size,
+                       compress=compress, interleave="band", BIGTIFF="IF_SAFER")
+        if nodata is not None:
+            profile.update(nodata=nodata)
+        
+        self.dst = rasterio.open(output_raster, "w", **profile)
+        for band, name in enumerate(self.band_names, start=1):
+            self.dst.set_band_description(band, name)
     
-    # Put the row, column and linear indices of all elements in a dataframe
-    shape = array.shape
-    index = pd.MultiIndex.from_product([range(s)for s in shape], names=columns)
-    df = pd.DataFrame({'all_index': array.flatten()}, index=index).reset_index()
-    df["all_index"] = df.index
     
-    df = df.astype({"row": np.int32, "column": np.int32, "all_index": np.int32})
-    return df
+    def write(self, band_name, input_array, fill_raster=None):
+        
+        band       = self.band_names.index(str(band_name)) + 1
+        fill_value = self.nodata if fill_raster is None else None
+        self.window.write_band(self.dst, band, input_array, fill_raster, fill_value)
+    
+    
+    def close(self):
+        
+        self.dst.close()
 
 
 
+class RasterWriter:
+    """
+    Background writer for output grids. Arrays handed to submit are written by
+    a single thread through the write method of the target (a RasterWindow, or
+    a RasterStack for time series), so the projection of the next decade does
+    not wait on disk. The queue is bounded to keep at most a couple of pending
+    grids in memory, and errors of the writer are raised on close.
+    """
+    
+    def __init__(self, target, max_pending=2):
+        
+        self.target = target
+        self.queue  = queue.Queue(maxsize=max_pending)
+        self.error  = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    
+    def _run(self):
+        
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            
+            # Keep draining the queue after a failure so that submit never blocks forever
+            if self.error is None:
+                try:
+                    self.target.write(*task)
+                except Exception as error:
+                    self.error = error
+    
+    
+    def submit(self, output, input_array):
+        
+        if self.error is not None:
+            raise self.error
+        
+        # The array is copied so the caller can keep updating its own
+        self.queue.put((output, np.array(input_array, copy=True)))
+    
+    
+    def close(self):
+        
+        # Wait for the pending writes to finish
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+    
+    
+    def __enter__(self):
+        
+        return self
+    
+    
+    def __exit__(self, *exc):
+        
+        self.close()
+    
+
+
 def suitability_estimator(pop_dist_params):
 
     import numpy as np
@@ -88,43 +334,160 @@ def suitability_estimator(pop_dist_params):
     
 
 
-def dist_matrix_calculator(first_index, cut_off_meters, all_indices, coors_csv_file):
+def stencil_generator(shape, resolution, cut_off_meters, cache_dir=None):
     
-    # Read all points with their coordinates
-    points = np.genfromtxt(coors_csv_file, delimiter = ',', skip_header = 1, usecols = (0, 1, 2),
-                           dtype = float)
+    # Stencils depend only on the grid geometry, so they are reused across runs when cached
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "stencil_{}x{}_{:g}x{:g}m_{:g}m.npz".format(
+                                  shape[0], shape[1], resolution[0], resolution[1], cut_off_meters))
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                row_diffs = cached["row_diff"]
+                col_diffs = cached["col_diff"]
+                distances = cached["dis"]
+            return _stencil_frame(row_diffs, col_diffs, distances, shape)
     
-    # Calculate distances between the first point and all other points within the specified neighborhood
+    # Largest row and column offsets that can fall within the neighborhood
     cut_off_metres = cut_off_meters + 1
-    tree_1 = cKDTree(points[first_index:first_index + 1, [1, 2]])
-    tree_2 = cKDTree(points[:, [1, 2]])         
-    tree_dist = cKDTree.sparse_distance_matrix(tree_1, tree_2, cut_off_metres, output_type  = 'dict',
-                                               p = 2)
+    max_row = int(cut_off_metres // resolution[1])
+    max_col = int(cut_off_metres // resolution[0])
     
-    # Put distances and indices of neighboring in a dataframe 
-    dist_df = pd.DataFrame(columns = ["near_id", "dis"])                 
-    dist_df["near_id"]  = [near_id[1] for near_id in list(tree_dist.keys())]
-    dist_df["dis"]      = tree_dist.values()  
-    dist_df = dist_df.loc[dist_df.dis != 0, :] # Remove the distance to itself
+    # Integer offsets of all candidate neighbors and their distances from the focal point
+    row_diffs, col_diffs = np.mgrid[-max_row:max_row + 1, -max_col:max_col + 1]
+    row_diffs = row_diffs.ravel().astype(np.int32)
+    col_diffs = col_diffs.ravel().astype(np.int32)
+    distances = np.hypot(row_diffs * float(resolution[1]), col_diffs * float(resolution[0]))
     
-    # Bring row and column indices of neighboring points by a join
-    dist_df = dist_df.join(all_indices, on = "near_id")
+    # Keep neighbors within the cut-off distance, excluding the focal point itself
+    within    = (distances <= cut_off_metres) & (distances != 0)
+    row_diffs = row_diffs[within]
+    col_diffs = col_diffs[within]
+    distances = distances[within]
     
-    # Add to columns holding the relative difference in rows and colums beween focal point and its neighbors
-    foc_indices = all_indices.loc[first_index, ["row", "column"]].values  
-    dist_df["ind_diff"] = dist_df["near_id"] - first_index
-    dist_df["row_diff"] = dist_df["row"] - foc_indices[0]
-    dist_df["col_diff"] = dist_df["column"] - foc_indices[1]
+    # The stencil is written under a temporary name and renamed once complete, so that an interrupted run
+    # or another process writing the same stencil never leaves a truncated file under the final name
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        part_file = cache_file[:-len(".npz")] + ".{}.part.npz".format(os.getpid())
+        np.savez(part_file, row_diff=row_diffs, col_diff=col_diffs, dis=distances)
+        os.replace(part_file, cache_file)
+    
+    return _stencil_frame(row_diffs, col_diffs, distances, shape)
+
+
+
+def _stencil_frame(row_diffs, col_diffs, distances, shape):
+    
+    # Linear index offsets follow from the row and column offsets and the raster width
+    dist_df = pd.DataFrame({"dis": distances, "ind_diff": row_diffs * shape[1] + col_diffs,
+                            "row_diff": row_diffs, "col_diff": col_diffs})
     
-    # Drop unwanted columns
-    dist_df = dist_df.drop(["row", "column", "near_id", "all_index"], axis = 1)
-        
     dist_df = dist_df.astype({"ind_diff": np.int32, "row_diff": np.int32, "col_diff": np.int32})
-        
+    
     return dist_df
 
 
 
+def stencil_truncator(dist_matrix, b, tolerance):
+    
+    # Without a distance decay every neighbor keeps its full weight
+    ini_dist = dist_matrix["dis"].values/1000.0
+    if b <= 0 or tolerance is None:
+        return dist_matrix, dist_matrix["dis"].max(), 0.0
+    
+    # Neighbors whose weight drops below the tolerance relative to the closest neighbor are left out
+    cut_off_km = ini_dist.min() + np.log(1.0/tolerance)/b
+    weights    = np.exp(-b * ini_dist)
+    
+    # The cut-off is rounded up to a fixed ladder of radii, half an octave apart below the full
+    # neighborhood, so that the betas visited by the optimizer share a few stencils (and engines)
+    max_km = ini_dist.max()
+    if cut_off_km < max_km:
+        cut_off_km = max_km * 2**(-np.floor(2 * np.log2(max_km/cut_off_km))/2)
+    kept = ini_dist <= cut_off_km
+    
+    # Kernel weight of the dropped neighbours, which bounds the truncation error together with the
+    # population left out (see TruncatedSuitability.error_bound)
+    dropped_weight = weights[~kept].sum()
+    
+    return dist_matrix.loc[kept], min(cut_off_km * 1000.0, dist_matrix["dis"].max()), dropped_weight
+
+
+
+def neighbour_counts(valid, dist_matrix, within_indices, shape, wrap=False):
+    
+    # Number of valid (non-NaN) neighbours of every within-boundary cell under a stencil. The grid engines
+    # only count neighbours inside the raster, while the per-cell engines follow linear offsets, where
+    # negative ones wrap around as with numpy indexing and those past the end are left out
+    valid          = np.asarray(valid, dtype=np.float64).ravel()
+    within_indices = np.asarray(within_indices, dtype=np.int64)
+    
+    if wrap:
+        
+        # Correlate a copy of the raster preceded by itself and followed by missing cells with the offsets.
+        # Offsets that reach past a row repeat others, and each of them counts
+        ind_diffs = dist_matrix["ind_diff"].values.astype(np.int64)
+        low, high = int(ind_diffs.min()), int(ind_diffs.max())
+        extended  = np.concatenate([valid, valid, np.zeros(max(high, 0))])
+        kernel    = np.zeros(high - low + 1)
+        np.add.at(kernel, ind_diffs - low, 1)
+        
+        fft_size = scipy.fft.next_fast_len(len(extended) + len(kernel) - 1, real=True)
+        counts   = scipy.fft.irfft(scipy.fft.rfft(extended, fft_size) * scipy.fft.rfft(kernel[::-1], fft_size),
+                                   fft_size, workers=max_workers)
+        counts   = counts[within_indices + len(valid) + high]
+    
+    else:
+        
+        # Correlate the valid cells with the stencil placed in a kernel array centred on the focal cell
+        row_diffs = dist_matrix["row_diff"].values
+        col_diffs = dist_matrix["col_diff"].values
+        radius    = (int(np.abs(row_diffs).max()), int(np.abs(col_diffs).max()))
+        kernel    = np.zeros([2 * r + 1 for r in radius])
+        kernel[row_diffs + radius[0], col_diffs + radius[1]] = 1
+        
+        fft_shape = tuple(scipy.fft.next_fast_len(n + 2 * r, real=True) for n, r in zip(shape, radius))
+        counts    = scipy.fft.irfft2(scipy.fft.rfft2(valid.reshape(shape), fft_shape) * 
+                                     scipy.fft.rfft2(kernel[::-1, ::-1], fft_shape), fft_shape, workers=max_workers)
+        counts    = counts[within_indices // shape[1] + radius[0], within_indices % shape[1] + radius[1]]
+    
+    return np.rint(counts)
+
+
+
+def raster_aggregator(raster_array, shape, factor, how="sum"):
+    
+    # Pad the grid with NaN so that both dimensions are multiples of the factor
+    rows   = -(-shape[0] // factor) * factor
+    cols   = -(-shape[1] // factor) * factor
+    padded = np.full((rows, cols), np.nan)
+    padded[:shape[0], :shape[1]] = np.asarray(raster_array, dtype=np.float64).reshape(shape)
+    
+    # Sum or average the valid cells of every factor x factor block
+    blocks = padded.reshape(rows // factor, factor, cols // factor, factor)
+    valid  = (~np.isnan(blocks)).sum(axis=(1, 3))
+    agg_array = np.nansum(blocks, axis=(1, 3))
+    if how == "mean":
+        agg_array = agg_array / np.maximum(valid, 1)
+    
+    # Blocks without any valid cell stay NaN
+    agg_array[valid == 0] = np.nan
+    
+    return agg_array.ravel(), agg_array.shape
+
+
+
+def index_aggregator(within_indices, shape, factor):
+    
+    # Linear indices of the coarse cells that contain at least one within-boundary cell
+    within_indices = np.asarray(within_indices, dtype=np.int64)
+    coarse_cols    = -(-shape[1] // factor)
+    coarse_indices = (within_indices // shape[1] // factor) * coarse_cols + (within_indices % shape[1]) // factor
+    
+    return np.unique(coarse_indices)
+
+
+
 def raster_array_modifier(raster_array, within_indices):
     
     mod_raster_array = raster_array[within_indices]
@@ -135,114 +498,1349 @@ def raster_array_modifier(raster_array, within_indices):
 
 
 
-def pop_min_function(z, *params):
+class PoolSuitability:
+    """
+    Per-cell suitability engine. Every within-boundary cell is handed to 
+    suitability_estimator through a process pool. This is the original path and
+    is kept to verify the grid-level engines.
+    """
     
-    #Initialize the parameters
-    a,b = z
+    def __init__(self, population, dist_matrix, within_indices, shape):
+        
+        self.population     = population
+        self.within_indices = within_indices
+        
+        # Differences in index between focal and nearby points as a template  
+        self.ind_diffs = dist_matrix["ind_diff"].values
+        
+        # Distances between current point and its close points
+        self.ini_dist  = dist_matrix["dis"].values/1000.0
+    
+    
+    def evaluate(self, a, b):
+        
+        exp_xx_inv_beta_dist = np.exp(-b * self.ini_dist)
+        
+        #Initialize the parallelization
+        pool = Pool(processes = max_workers)
+        
+        # Provide the inputs for the parallelized function
+        parallel_elements = [(i, self.ind_diffs, self.population, a, exp_xx_inv_beta_dist) 
+                             for i in self.within_indices]
+    
+        # Derive suitability estimates
+        suitability_estimates = pool.map(suitability_estimator, parallel_elements)
+        
+        return np.array(suitability_estimates)
+    
+    
+    def close(self):
+        
+        # A new pool is created per evaluation, so there is nothing to release
+        pass
 
-    # Inputs to the optimization
-    population_1st  = params[0] # Population of points in the first year (urban/rural)
-    population_2nd  = params[1] # Population of points in the second year (urban/rural)
-    points_mask     = params[2] # Mask values of points 
-    dist_matrix     = params[3] # Template distance matrix
-    within_indices  = params[4] # Indices of points within the state boundary (subset of the above)
+
+
+class GridSuitability:
+    """
+    Grid-level suitability engine. The distance decay is treated as a 2-D kernel
+    and nanmean(pop**alpha * exp(-b*d)) is derived for all cells at once as the
+    ratio of two FFT correlations: the weighted population sum and the number of
+    valid (non-NaN) neighbours. Neighbours outside the raster are not counted,
+    whereas the per-cell path wraps linear offsets across rows.
+    """
+    
+    def __init__(self, population, dist_matrix, within_indices, shape):
+        
+        self.shape = tuple(shape)
+        
+        # Rows and columns of the cells whose suitability is needed
+        within_indices   = np.asarray(within_indices, dtype=np.int64)
+        self.within_rows = within_indices // self.shape[1]
+        self.within_cols = within_indices %  self.shape[1]
+        
+        # NaN cells are excluded from both the sum and the neighbour count
+        population = np.asarray(population, dtype=np.float64).reshape(self.shape)
+        self.valid      = ~np.isnan(population)
+        self.population = np.where(self.valid, population, 0.0)
+        
+        # Place the stencil in a kernel array centred on the focal cell
+        row_diffs = dist_matrix["row_diff"].values
+        col_diffs = dist_matrix["col_diff"].values
+        self.radius       = (int(np.abs(row_diffs).max()), int(np.abs(col_diffs).max()))
+        self.kernel_index = (row_diffs + self.radius[0], col_diffs + self.radius[1])
+        self.ini_dist     = dist_matrix["dis"].values/1000.0
+        
+        # Padded FFT shape for a linear (non-circular) correlation
+        self.fft_shape = tuple(scipy.fft.next_fast_len(n + 2 * r, real=True)
+                               for n, r in zip(self.shape, self.radius))
+        
+        # Number of valid neighbours of each within-boundary cell
+        counts      = self.correlate(self.valid.astype(np.float64), self.kernel(np.ones(len(self.ini_dist))))
+        self.counts = np.rint(counts)
     
-    # Outputs of the optimization at each step
-    pop_estimates  = np.zeros(len(within_indices)) #Population estimates in the second year
+    
+    def kernel(self, weights):
+        
+        kernel = np.zeros([2 * r + 1 for r in self.radius])
+        kernel[self.kernel_index] = weights
+        
+        # Flip the kernel so that the FFT convolution becomes a correlation
+        return kernel[::-1, ::-1]
     
     
-    # Calculate aggregate population at times 1 and 2 
-    pop_t1_array = raster_array_modifier(population_1st, within_indices) 
-    pop_t2_array = raster_array_modifier(population_2nd, within_indices) 
+    def kernel_spectrum(self, b):
+        
+        return scipy.fft.rfft2(self.kernel(np.exp(-b * self.ini_dist)), self.fft_shape, workers=max_workers)
+    
+    
+    def population_spectrum(self, a):
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pop_xx_alpha = np.where(self.population > 0, np.power(self.population, a), self.population)
+        
+        return scipy.fft.rfft2(pop_xx_alpha, self.fft_shape, workers=max_workers)
+    
+    
+    def within_values(self, spectrum):
+        
+        # Works on a single spectrum or on a stack of spectra along the leading axes
+        full = scipy.fft.irfft2(spectrum, self.fft_shape, workers=max_workers)
+        
+        # Keep only the within-boundary cells and remove FFT round-off around zero 
+        values = full[..., self.within_rows + self.radius[0], self.within_cols + self.radius[1]]
+        scale  = np.abs(full).max(axis=(-2, -1))[..., np.newaxis]
+        values[np.abs(values) < 1e-10 * scale] = 0
+        
+        return values
+    
+    
+    def correlate(self, array, kernel):
+        
+        spectrum = (scipy.fft.rfft2(array, self.fft_shape, workers=max_workers) * 
+                    scipy.fft.rfft2(kernel, self.fft_shape, workers=max_workers))
+        
+        return self.within_values(spectrum)
+    
+    
+    def evaluate(self, a, b):
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimates = self.within_values(self.population_spectrum(a) * self.kernel_spectrum(b)) / self.counts
+        
+        return estimates
+    
+    
+    def evaluate_grid(self, a_list, b_list):
+        
+        # Kernel spectra are derived once per beta and population spectra once per alpha
+        kernel_spectra = np.stack([self.kernel_spectrum(b) for b in b_list])
+        
+        estimates = np.empty((len(a_list), len(b_list), len(self.counts)))
+        for i, a in enumerate(a_list):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                estimates[i] = self.within_values(self.population_spectrum(a) * kernel_spectra) / self.counts
+        
+        return estimates
+    
+    
+    def evaluate_members(self, populations, a_values, b_values):
+        
+        # Ensemble members share the NaN cells (and so the neighbour counts) of the population given to
+        # the constructor, but each has its own population, alpha and beta. Their spectra are derived
+        # in one batched FFT
+        populations = np.asarray(populations, dtype=np.float64).reshape((-1,) + self.shape)
+        populations = np.where(self.valid, populations, 0.0)
+        a_values    = np.asarray(a_values, dtype=np.float64)[:, np.newaxis, np.newaxis]
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pop_xx_alpha = np.where(populations > 0, np.power(populations, a_values), populations)
+        
+        spectra = (scipy.fft.rfft2(pop_xx_alpha, self.fft_shape, workers=max_workers) * 
+                   np.stack([self.kernel_spectrum(b) for b in b_values]))
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimates = self.within_values(spectra) / self.counts
+        
+        return estimates
+    
+    
+    def close(self):
+        
+        # All arrays live in the current process, so there is nothing to release
+        pass
 
-    pop_t1 = pop_t1_array.sum()
-    pop_t2 = pop_t2_array.sum()
+
+
+class StreamingStatistics:
+    """
+    Per-cell summary of an ensemble that is seen in batches of members. Mean and
+    variance are accumulated with Welford's update (in Chan's form for batches)
+    and quantiles are taken from a reservoir sample of whole members, so memory
+    does not grow with the ensemble size. Quantiles are exact as long as the
+    ensemble fits in the reservoir.
+    """
     
+    def __init__(self, cells, reservoir_size=100, seed=None):
+        
+        self.count     = 0
+        self.mean      = np.zeros(cells)
+        self.m2        = np.zeros(cells)
+        self.reservoir = np.empty((reservoir_size, cells))
+        self.rng       = np.random.default_rng(seed)
     
-    #Population change between the two reference years    
-    pop_change = pop_t2 - pop_t1    
-    if pop_change < 0:
-        negative_mod = 1
-    else:
-        negative_mod = 0
     
-    # Differences in index between focal and nearby points as a template  
-    ind_diffs = dist_matrix["ind_diff"].values
+    def update(self, values):
+        
+        values = np.atleast_2d(values)
+        count  = self.count + len(values)
+        
+        # Combine the mean and sum of squared deviations of the batch with the running ones
+        batch_mean = values.mean(axis=0)
+        batch_m2   = ((values - batch_mean)**2).sum(axis=0)
+        delta      = batch_mean - self.mean
+        self.mean += delta * len(values)/count
+        self.m2   += batch_m2 + delta**2 * self.count * len(values)/count
+        
+        # Every member seen so far is in the reservoir with the same probability
+        for seen, member in enumerate(values, start=self.count):
+            if seen < len(self.reservoir):
+                self.reservoir[seen] = member
+            else:
+                slot = self.rng.integers(0, seen + 1)
+                if slot < len(self.reservoir):
+                    self.reservoir[slot] = member
+        
+        self.count = count
+    
     
-    # Distances between current point and its close points
-    ini_dist = dist_matrix["dis"].values/1000.0
-    dist     = -b * ini_dist
+    def variance(self):
+        
+        return self.m2 / max(self.count - 1, 1)
     
-    exp_xx_inv_beta_dist = np.exp(dist)
     
-    #Initialize the parallelization
-    pool = Pool(processes = multiprocessing.cpu_count() - 1)
+    def quantiles(self, q):
+        
+        return np.quantile(self.reservoir[:min(self.count, len(self.reservoir))], q, axis=0)
+
+
+
+def _shared_worker_init(specs):
     
-    # Provide the inputs for the parallelized function
-    parallel_elements = [(i, ind_diffs, population_1st, a, exp_xx_inv_beta_dist) for i in within_indices]
+    # Attach the shared memory blocks published by the parent process
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_arrays[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
 
-    # Derive suitability estimates
-    suitability_estimates = pool.map(suitability_estimator, parallel_elements)
 
-    #Change suitability estimates to a numpy array
-    suitability_estimates = np.array(suitability_estimates)
+def _shared_worker_evaluate(a, b, start, stop):
     
-    # Exract only the necessary mask values that fall within the state boundary
-    points_mask = raster_array_modifier(points_mask, within_indices)  
+    population     = _shared_arrays["population"][1]
+    within_indices = _shared_arrays["within_indices"][1]
+    ind_diffs      = _shared_arrays["ind_diffs"][1]
+    ini_dist       = _shared_arrays["ini_dist"][1]
+    
+    # The kernel is derived once per task rather than once per cell
+    exp_xx_inv_beta_dist = np.exp(-b * ini_dist)
+    
+    estimates = [suitability_estimator((i, ind_diffs, population, a, exp_xx_inv_beta_dist)) 
+                 for i in within_indices[start:stop]]
+    
+    return np.array(estimates)
 
 
-    # In case of population decline, suitability estimates are reciprocated for non-zero values       
-    if negative_mod:
+
+class SharedSuitability:
+    """
+    Per-cell suitability engine backed by a long-lived process pool. The population
+    raster, the within-boundary indices and the stencil are published once through
+    shared memory, so every evaluation only sends (alpha, beta) and a range of cells
+    to each worker. The engine must be closed once it is no longer needed, also when
+    an evaluation fails, or used as a context manager.
+    """
+    
+    def __init__(self, population, dist_matrix, within_indices, shape, processes=None):
         
-        # find those whose mask is 0 but have population, they should decline anyway 
-        mask_zero    = np.where(points_mask == 0)[0]
-        pop_non_zero = np.where(pop_t1_array != 0)[0]
+        if processes is None:
+            processes = max_workers
         
-        # Those cells with mask value of zero and population are the intersection of the two above arrays
-        pop_mask = np.intersect1d(mask_zero, pop_non_zero, assume_unique=True)
+        arrays = {"population"     : np.asarray(population, dtype=np.float64),
+                  "within_indices" : np.asarray(within_indices, dtype=np.int64),
+                  "ind_diffs"      : dist_matrix["ind_diff"].values.astype(np.int64),
+                  "ini_dist"       : dist_matrix["dis"].values/1000.0}
         
-        # Change the mask value of the above cells to the mean so that they also lose population
-        points_mask[pop_mask] = points_mask.mean()
+        # Copy every array into its own shared memory block. Blocks created before a failure are released
+        self.blocks = {}
+        self.arrays = {}
+        self.pool   = None
+        specs       = {}
+        try:
+            for name, array in arrays.items():
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self.blocks[name] = block
+                self.arrays[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+                self.arrays[name][:] = array
+                specs[name] = (block.name, array.shape, array.dtype.str)
+            
+            self.pool = multiprocessing.Pool(processes, initializer=_shared_worker_init, initargs=(specs,))
+        except BaseException:
+            self.close()
+            raise
         
-        #Adjust suitability values by applying mask values
-        suitability_estimates = points_mask * suitability_estimates
+        # Split the within-boundary cells into a few contiguous ranges per worker
+        cell_count  = len(arrays["within_indices"])
+        chunk_size  = max(-(-cell_count // (processes * 4)), 1)
+        self.ranges = [(start, min(start + chunk_size, cell_count)) 
+                       for start in range(0, cell_count, chunk_size)]
+    
+    
+    def publish_population(self, population):
         
-        # Inverse current mask values for a better reflection of population decline
-        suitability_estimates[suitability_estimates != 0] = 1.0/suitability_estimates[suitability_estimates != 0]
+        # Workers read the shared block directly, so a new population only needs a copy
+        self.arrays["population"][:] = population
     
-    else:
-        # Adjust suitability values by applying mask values
-        suitability_estimates = points_mask * suitability_estimates
     
-    # Total suitability for the whole area, which is the summation of all individual suitability values
-    tot_suitability = suitability_estimates.sum()
+    def evaluate(self, a, b):
+        
+        tasks     = [(a, b, start, stop) for start, stop in self.ranges]
+        estimates = self.pool.starmap(_shared_worker_evaluate, tasks)
+        
+        return np.concatenate(estimates)
     
-    # Final population estimate for each point if nagative mode is off
-    pop_estimates = suitability_estimates/tot_suitability * pop_change + pop_t1_array
     
-    if negative_mod:
-        while any(pop < 0 for pop in pop_estimates): #To ensure there is no negative population
-            new_tot_suitability = 0 #Total suitability calculated over points with positive population
-            extra_pop_mod       = 0 #For adjusting negative population values
-            
-            #Treating negative population values
-            extra_pop_mod = abs(pop_estimates[pop_estimates < 0].sum())
-            pop_estimates[pop_estimates < 0] = 0
+    def close(self):
+        
+        # Closing more than once is harmless
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
 
-            #Calculate the new total suitability value based on those points whose projected population is positive                
-            new_tot_suitability = suitability_estimates[pop_estimates > 0].sum()       
-            
-            #Adjust non-negative population values to maintain the total aggregated population 
-            pop_estimates[pop_estimates > 0] = pop_estimates[pop_estimates > 0] - (suitability_estimates[pop_estimates > 0]/new_tot_suitability) * extra_pop_mod
 
 
-    # Produce the total error compared to observed values 
-    # population_2nd = raster_array_modifier(population_2nd, within_indices)   
-    tot_error = abs(pop_t2_array - pop_estimates).sum()
+def _fused_suitability(population, within_indices, ind_diffs, exp_xx_inv_beta_dist, a, points_mask, negative_mod):
     
-    print("the first run is done")
+    size      = population.shape[0]
+    estimates = np.empty(within_indices.shape[0])
+    
+    for k in numba.prange(within_indices.shape[0]):
+        
+        pop_dist_sum = 0.0
+        count        = 0
+        for j in range(ind_diffs.shape[0]):
+            
+            # Negative indices wrap around as they do with numpy indexing
+            neigh_index = within_indices[k] + ind_diffs[j]
+            if neigh_index < 0:
+                neigh_index += size
+            if neigh_index < 0 or neigh_index >= size:
+                continue
+            
+            # NaN populations are left out of the mean, as with np.nanmean
+            pop = population[neigh_index]
+            if np.isnan(pop):
+                continue
+            if pop > 0:
+                pop = pop ** a
+            
+            pop_dist_sum += pop * exp_xx_inv_beta_dist[j]
+            count        += 1
+        
+        if count > 0:
+            estimate = pop_dist_sum / count
+        else:
+            estimate = np.nan
+        
+        # Apply mask values and, in case of population decline, reciprocate non-zero values
+        if points_mask.shape[0] > 0:
+            estimate = points_mask[k] * estimate
+            if negative_mod and estimate != 0:
+                estimate = 1.0 / estimate
+        
+        estimates[k] = estimate
+    
+    return estimates
+
+
+if numba is not None:
+    _fused_suitability = numba.njit(parallel=True, cache=True)(_fused_suitability)
+
+
+
+class NumbaSuitability:
+    """
+    Per-cell suitability engine compiled with numba. The stencil gather, the alpha
+    transform, the distance weighting and the nanmean of suitability_estimator run
+    in one parallel loop over cells. When allocating, the mask and decline
+    adjustments of pop_allocator run in the same loop. No per-cell temporaries or
+    worker processes are needed.
+    """
+    
+    def __init__(self, population, dist_matrix, within_indices, shape):
+        
+        if numba is None:
+            raise ImportError("numba is required by the numba suitability engine")
+        
+        numba.set_num_threads(min(max_workers, numba.config.NUMBA_NUM_THREADS))
+        
+        self.population     = np.ascontiguousarray(population, dtype=np.float64)
+        self.within_indices = np.asarray(within_indices, dtype=np.int64)
+        self.ind_diffs      = dist_matrix["ind_diff"].values.astype(np.int64)
+        self.ini_dist       = dist_matrix["dis"].values/1000.0
+    
+    
+    def evaluate(self, a, b):
+        
+        return _fused_suitability(self.population, self.within_indices, self.ind_diffs, 
+                                  np.exp(-b * self.ini_dist), float(a), np.empty(0), False)
+    
+    
+    def allocate(self, a, b, points_mask, pop_t1_array, pop_change, negative_mod):
+        
+        suitability_estimates = _fused_suitability(self.population, self.within_indices, self.ind_diffs,
+                                                   np.exp(-b * self.ini_dist), float(a), 
+                                                   np.asarray(points_mask, dtype=np.float64), bool(negative_mod))
+        
+        return pop_distributor(suitability_estimates, pop_t1_array, pop_change)
+    
+    
+    def close(self):
+        
+        # Compiled loops run in threads of the current process, so there is nothing to release
+        pass
+
+
+
+class SparseSuitability:
+    """
+    Suitability engine based on a sparse CSR matrix whose rows hold the distances
+    between every within-boundary cell and its in-raster neighbours, so offsets
+    never wrap across rows. The matrix does not depend on alpha or beta: a beta
+    change only rescales the stored distances and suitability becomes a sparse
+    mat-vec against pop**alpha. With a cache directory the matrix is written
+    once and memory-mapped by later runs. Both the build and the mat-vecs run
+    over chunks of rows, so memory stays proportional to a chunk rather than to
+    the number of stored neighbours.
+    """
+    
+    def __init__(self, population, dist_matrix, within_indices, shape, cache_dir=None):
+        
+        self.shape          = tuple(shape)
+        self.within_indices = np.asarray(within_indices, dtype=np.int64)
+        
+        # NaN cells are excluded from both the sum and the neighbour count
+        population      = np.asarray(population, dtype=np.float64)
+        self.valid      = ~np.isnan(population)
+        self.population = np.where(self.valid, population, 0.0)
+        
+        self.indptr, self.indices, self.ini_dist = self.neighbour_matrix(dist_matrix, cache_dir)
+        
+        # Rows per chunk of the mat-vecs, sized like the chunks of the build
+        self.chunk = max(2**22 // max(len(dist_matrix), 1), 1)
+        
+        # Number of valid neighbours of each within-boundary cell
+        self.counts = self.mat_vec(self.valid.astype(np.float64))
+    
+    
+    def neighbour_matrix(self, dist_matrix, cache_dir):
+        
+        row_diffs = dist_matrix["row_diff"].values.astype(np.int64)
+        col_diffs = dist_matrix["col_diff"].values.astype(np.int64)
+        distances = (dist_matrix["dis"].values/1000.0).astype(np.float32)
+        
+        # Linear indices of the window grid fit in 32 bits, which halves the largest array
+        index_dtype = np.int32 if self.shape[0] * self.shape[1] < 2**31 else np.int64
+        
+        # The matrix depends only on the grid shape, the within-boundary cells and the stencil
+        if cache_dir is not None:
+            key = hashlib.sha1()
+            for array in (self.within_indices, row_diffs, col_diffs, distances):
+                key.update(np.ascontiguousarray(array).tobytes())
+            cache_files = [os.path.join(cache_dir, "neighbours_{}x{}_{}_{}.npy".format(
+                           self.shape[0], self.shape[1], key.hexdigest()[:16], name)) 
+                           for name in ("indptr", "indices", "dis")]
+            if all(os.path.exists(cache_file) for cache_file in cache_files):
+                return tuple(np.load(cache_file, mmap_mode="r") for cache_file in cache_files)
+            os.makedirs(cache_dir, exist_ok=True)
+        
+        within_rows = self.within_indices // self.shape[1]
+        within_cols = self.within_indices %  self.shape[1]
+        chunks      = range(0, len(self.within_indices), max(2**22 // max(len(distances), 1), 1))
+        
+        def neighbours(start):
+            rows  = within_rows[start:start + chunks.step, np.newaxis] + row_diffs
+            cols  = within_cols[start:start + chunks.step, np.newaxis] + col_diffs
+            valid = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+            return rows, cols, valid
+        
+        # First pass counts the in-raster neighbours of every cell to size the arrays
+        indptr = np.zeros(len(self.within_indices) + 1, dtype=np.int64)
+        for start in chunks:
+            indptr[start + 1:start + 1 + chunks.step] = neighbours(start)[2].sum(axis=1)
+        indptr = np.cumsum(indptr)
+        
+        # Cached arrays are written under temporary names and only renamed once complete, so an
+        # interrupted run never leaves a partial matrix behind under the final names
+        if cache_dir is not None:
+            part_files = [cache_file[:-len(".npy")] + ".{}.part.npy".format(os.getpid()) 
+                          for cache_file in cache_files]
+            np.save(part_files[0], indptr)
+            indices  = np.lib.format.open_memmap(part_files[1], mode="w+", dtype=index_dtype, 
+                                                 shape=(int(indptr[-1]),))
+            ini_dist = np.lib.format.open_memmap(part_files[2], mode="w+", dtype=np.float32, 
+                                                 shape=(int(indptr[-1]),))
+        else:
+            indices  = np.empty(indptr[-1], dtype=index_dtype)
+            ini_dist = np.empty(indptr[-1], dtype=np.float32)
+        
+        # Second pass fills in the linear indices and distances of the neighbours
+        for start in chunks:
+            rows, cols, valid = neighbours(start)
+            stop = indptr[min(start + chunks.step, len(self.within_indices))]
+            indices[indptr[start]:stop]  = (rows * self.shape[1] + cols)[valid]
+            ini_dist[indptr[start]:stop] = np.broadcast_to(distances, valid.shape)[valid]
+        
+        if cache_dir is not None:
+            indices.flush()
+            ini_dist.flush()
+            del indices, ini_dist
+            
+            # The maps are released before renaming (required on Windows), and indptr is renamed last as
+            # the other files are useless without it
+            for part_file, cache_file in list(zip(part_files, cache_files))[::-1]:
+                os.replace(part_file, cache_file)
+            
+            return tuple(np.load(cache_file, mmap_mode="r") for cache_file in cache_files)
+        
+        return indptr, indices, ini_dist
+    
+    
+    def mat_vec(self, vector, b=None):
+        
+        # Product of the matrix, weighted by exp(-b*d) (or by ones without a beta), with a vector. Each chunk
+        # of rows is a small CSR matrix, so the weights and the (32-bit) indices are only ever held per chunk
+        result = np.empty(len(self.within_indices))
+        for start in range(0, len(self.within_indices), self.chunk):
+            stop    = min(start + self.chunk, len(self.within_indices))
+            low     = self.indptr[start]
+            high    = self.indptr[stop]
+            weights = np.ones(high - low) if b is None else np.exp(-b * self.ini_dist[low:high].astype(np.float64))
+            chunk   = scipy.sparse.csr_matrix((weights, self.indices[low:high], self.indptr[start:stop + 1] - low),
+                                              shape=(stop - start, len(self.population)))
+            result[start:stop] = chunk @ vector
+        
+        return result
+    
+    
+    def evaluate(self, a, b):
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pop_xx_alpha = np.where(self.population > 0, np.power(self.population, a), self.population)
+            estimates    = self.mat_vec(pop_xx_alpha, b) / self.counts
+        
+        return estimates
+    
+    
+    def close(self):
+        
+        # Memory-mapped arrays are released with the engine
+        pass
+
+
+
+class TruncatedSuitability:
+    """
+    Wraps any other engine so that every evaluation uses only the neighbours whose
+    weight exp(-b*d) stays above a relative tolerance, as derived by
+    stencil_truncator. Engines are built once per truncated stencil and reused.
+    Only a few are kept at a time. Only the weighted sum is truncated: the inner
+    engine's means are rescaled by the ratio of the truncated to the full
+    stencil's valid-neighbour counts, so that every cell is still divided by its
+    full-stencil count. Near NaN areas and raster edges that ratio differs from
+    cell to cell and would otherwise bias the allocation. Every evaluation
+    prints a bound on the error that the truncation introduces.
+    """
+    
+    def __init__(self, engine, population, dist_matrix, within_indices, shape, tolerance, 
+                 cache_dir=None, max_engines=4):
+        
+        self.engine         = engine
+        self.population     = population
+        self.dist_matrix    = dist_matrix.sort_values("dis", kind="stable")
+        self.within_indices = within_indices
+        self.shape          = shape
+        self.tolerance      = tolerance
+        self.cache_dir      = cache_dir
+        self.max_engines    = max_engines
+        self.engines        = {}
+        
+        # Per-cell engines count neighbours along linear offsets, grid engines within the raster
+        self.wrap  = engine not in ("fft", "sparse")
+        self.valid = ~np.isnan(np.asarray(population, dtype=np.float64))
+        
+        # Range of the positive populations, which bounds pop^a for any alpha
+        positive       = np.asarray(population, dtype=np.float64)[self.valid]
+        positive       = positive[positive > 0]
+        self.pop_range = (positive.min(), positive.max()) if len(positive) else None
+        
+        # Valid neighbours of the full stencil, by which all the truncated sums are divided
+        self.counts = neighbour_counts(self.valid, self.dist_matrix, within_indices, shape, self.wrap)
+    
+    
+    def engine_for(self, b):
+        
+        dist_matrix, cut_off_meters, dropped_weight = stencil_truncator(self.dist_matrix, b, self.tolerance)
+        
+        # Truncated stencils are prefixes of the distance-sorted stencil, so their length identifies them
+        key = len(dist_matrix)
+        if key not in self.engines:
+            print("kernel truncated at {:.0f} m ({} neighbors)".format(cut_off_meters, key))
+            
+            if len(self.engines) >= self.max_engines:
+                self.engines.pop(next(iter(self.engines)))[0].close()
+            
+            # Ratio of the truncated to the full valid-neighbour count of every cell
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = neighbour_counts(self.valid, dist_matrix, self.within_indices, self.shape, 
+                                         self.wrap) / self.counts
+            
+            self.engines[key] = (suitability_engine(self.engine, self.population, dist_matrix, 
+                                                    self.within_indices, self.shape, self.cache_dir), 
+                                 scale, cut_off_meters, dropped_weight)
+        
+        return self.engines[key]
+    
+    
+    def error_bound(self, a, estimates, dropped_weight):
+        
+        # Each dropped neighbour adds at most the largest pop^a times its weight to the sum of a cell, which
+        # is divided by the cell's full valid-neighbour count. The full estimate is never below the
+        # truncated one, so dividing by the latter bounds the relative error of cells with a positive one
+        if self.pop_range is None or dropped_weight == 0:
+            return 0.0, 0.0
+        largest = self.pop_range[1]**a if a >= 0 else self.pop_range[0]**a
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bound = largest * dropped_weight / self.counts
+        bound    = bound[self.counts > 0]
+        positive = estimates[self.counts > 0] > 0
+        relative = (bound[positive] / estimates[self.counts > 0][positive]).max() if positive.any() else 0.0
+        
+        return bound.max(initial=0.0), relative
+    
+    
+    def report(self, a, estimates, cut_off_meters, dropped_weight):
+        
+        return "kernel truncated at {:.0f} m: error at most {:.1e} ({:.1e} relative)".format(
+               cut_off_meters, *self.error_bound(a, estimates, dropped_weight))
+    
+    
+    def evaluate(self, a, b):
+        
+        engine, scale, cut_off_meters, dropped_weight = self.engine_for(b)
+        estimates = engine.evaluate(a, b) * scale
+        print(self.report(a, estimates, cut_off_meters, dropped_weight))
+        
+        return estimates
+    
+    
+    def evaluate_grid(self, a_list, b_list):
+        
+        # Each beta has its own truncated stencil, so the grid is evaluated one beta at a time
+        estimates = []
+        for b in b_list:
+            engine, scale, cut_off_meters, dropped_weight = self.engine_for(b)
+            if hasattr(engine, "evaluate_grid"):
+                estimates.append(engine.evaluate_grid(a_list, [b])[:, 0] * scale)
+            else:
+                estimates.append(np.array([engine.evaluate(a, b) * scale for a in a_list]))
+            for a, estimate in zip(a_list, estimates[-1]):
+                print(self.report(a, estimate, cut_off_meters, dropped_weight))
+        
+        return np.stack(estimates, axis=1)
+    
+    
+    def close(self):
+        
+        for engine, *_ in self.engines.values():
+            engine.close()
+        self.engines = {}
+
+
+
+def suitability_engine(engine, population, dist_matrix, within_indices, shape, cache_dir=None,
+                       tolerance=None):
+    
+    # An engine that has already been built is reused as it is
+    if not isinstance(engine, str):
+        return engine
+    
+    # With a tolerance, the stencil is truncated according to the beta of each evaluation
+    if tolerance is not None:
+        return TruncatedSuitability(engine, population, dist_matrix, within_indices, shape, tolerance,
+                                    cache_dir)
+    
+    # The compiled per-cell engine is used when numba is available
+    if engine == "auto":
+        engine = "numba" if numba is not None else "pool"
+    
+    # The sparse engine keeps its neighbour matrix in the cache directory
+    if engine == "sparse":
+        return SparseSuitability(population, dist_matrix, within_indices, shape, cache_dir)
+    
+    engines = {"pool": PoolSuitability, "shared": SharedSuitability, "numba": NumbaSuitability,
+               "fft": GridSuitability}
+    if engine not in engines:
+        raise ValueError("Unknown suitability engine: " + engine)
+    
+    return engines[engine](population, dist_matrix, within_indices, shape)
+
+
+
+def city_tiles(label_array, shape, tile_size):
+    
+    # Within-boundary cells of the city grid (non-zero borough labels) grouped by square tiles
+    within_indices = np.flatnonzero(np.nan_to_num(label_array) > 0)
+    within_rows    = within_indices // shape[1]
+    within_cols    = within_indices %  shape[1]
+    
+    tile_ids = (within_rows // tile_size) * -(-shape[1] // tile_size) + within_cols // tile_size
+    order    = np.argsort(tile_ids, kind="stable")
+    bounds   = np.flatnonzero(np.diff(tile_ids[order])) + 1
+    
+    return np.split(within_indices[order], bounds)
+
+
+
+def _tile_worker_init(dist_matrix, cut_off_meters, borough_params):
+    
+    # Tiles already run in parallel, so each worker keeps its FFTs on one thread
+    global max_workers
+    max_workers = 1
+    
+    _tile_inputs["dist_matrix"]    = dist_matrix
+    _tile_inputs["cut_off_meters"] = cut_off_meters
+    _tile_inputs["borough_params"] = borough_params
+
+
+
+def _tile_suitability(tile_params):
+    
+    # Suitability of the cells of one tile, read with a halo of the neighborhood distance
+    population_raster, tile_indices, tile_labels = tile_params
+    
+    window     = RasterWindow(population_raster, tile_indices, _tile_inputs["cut_off_meters"])
+    population = window.read(population_raster)
+    engine     = GridSuitability(population, _tile_inputs["dist_matrix"], window.within_indices, window.shape)
+    
+    # Every cell uses the alpha and beta of its own borough
+    suitability_estimates = np.zeros(len(tile_indices))
+    for label, (a, b) in _tile_inputs["borough_params"].items():
+        cells = tile_labels == label
+        if cells.any():
+            suitability_estimates[cells] = engine.evaluate(a, b)[cells]
+    
+    return suitability_estimates
+
+
+
+def city_suitability(population_raster, tiles, tile_labels, dist_matrix, cut_off_meters, borough_params):
+    
+    # Tiles are processed in parallel and no process holds more than a tile and its halo
+    tasks = [(population_raster, tile_indices, labels) for tile_indices, labels in zip(tiles, tile_labels)]
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_tile_worker_init,
+                                                initargs=(dist_matrix, cut_off_meters, borough_params)) as executor:
+        suitability_estimates = list(executor.map(_tile_suitability, tasks))
+    
+    return np.concatenate(suitability_estimates)
+
+
+
+def objective_inputs(population_1st, population_2nd, points_mask, within_indices):
+    
+    # Calculate aggregate population at times 1 and 2 
+    pop_t1_array = raster_array_modifier(population_1st, within_indices) 
+    pop_t2_array = raster_array_modifier(population_2nd, within_indices) 
+
+    pop_t1 = pop_t1_array.sum()
+    pop_t2 = pop_t2_array.sum()
+    
+    
+    #Population change between the two reference years    
+    pop_change = pop_t2 - pop_t1    
+    if pop_change < 0:
+        negative_mod = 1
+    else:
+        negative_mod = 0
+    
+    # Exract only the necessary mask values that fall within the state boundary
+    points_mask = raster_array_modifier(points_mask, within_indices)  
+    points_mask = mask_modifier(points_mask, pop_t1_array, negative_mod)
+    
+    return pop_t1_array, pop_t2_array, pop_change, negative_mod, points_mask
+
+
+
+def mask_modifier(points_mask, pop_t1_array, negative_mod):
+    
+    # In case of population decline, populated cells with a zero mask should decline anyway
+    if negative_mod:
+        
+        # find those whose mask is 0 but have population, they should decline anyway 
+        mask_zero    = np.where(points_mask == 0)[0]
+        pop_non_zero = np.where(pop_t1_array != 0)[0]
+        
+        # Those cells with mask value of zero and population are the intersection of the two above arrays
+        pop_mask = np.intersect1d(mask_zero, pop_non_zero, assume_unique=True)
+        
+        # Change the mask value of the above cells to the mean so that they also lose population
+        points_mask[pop_mask] = points_mask.mean()
+    
+    return points_mask
+
+
+
+def pop_allocator(suitability_estimates, points_mask, pop_t1_array, pop_change, negative_mod):
+    
+    #Adjust suitability values by applying mask values
+    suitability_estimates = points_mask * suitability_estimates
+    
+    # In case of population decline, suitability estimates are reciprocated for non-zero values       
+    if negative_mod:
+        
+        # Inverse current mask values for a better reflection of population decline
+        suitability_estimates[suitability_estimates != 0] = 1.0/suitability_estimates[suitability_estimates != 0]
+    
+    return pop_distributor(suitability_estimates, pop_t1_array, pop_change)
+
+
+
+def pop_distributor(suitability_estimates, pop_t1_array, pop_change):
+    
+    # Total suitability for the whole area, which is the summation of all individual suitability values
+    tot_suitability = suitability_estimates.sum()
+    
+    # Final population estimate for each point if nagative mode is off
+    pop_estimates = suitability_estimates/tot_suitability * pop_change + pop_t1_array
+    
+    # Make sure that no point ends up with a negative population
+    pop_estimates, redistribution = pop_redistributor(pop_estimates, suitability_estimates)
+    
+    return pop_estimates, redistribution
+
+
+
+def pop_redistributor(pop_estimates, suitability_estimates):
+    """
+    Clips negative population estimates to zero and takes the removed population
+    from the remaining positive cells in proportion to their suitability, so that
+    the total population is preserved. Repeating this until no estimate is
+    negative converges to pop - suitability * level clipped at zero for a single
+    level, which is found here in closed form by a sort-based water-fill.
+    """
+    
+    redistribution = {"negative_cells": 0, "clipped_cells": 0, "deficit": 0.0, "level": 0.0}
+    
+    negative = pop_estimates < 0
+    if not negative.any():
+        return pop_estimates, redistribution
+    
+    redistribution["negative_cells"] = int(negative.sum())
+    redistribution["deficit"]        = float(-pop_estimates[negative].sum())
+    
+    # Only positive cells with a positive suitability give away population
+    donors     = (pop_estimates > 0) & (suitability_estimates > 0)
+    donor_pop  = pop_estimates[donors]
+    donor_suit = suitability_estimates[donors]
+    
+    # Population the donors hold once the deficit is covered
+    target = donor_pop.sum() - redistribution["deficit"]
+    
+    if len(donor_pop) > 0:
+        
+        # A donor keeps population as long as the level stays below its pop/suitability ratio
+        thresholds = donor_pop/donor_suit
+        order      = np.argsort(thresholds)[::-1]
+        thresholds = thresholds[order]
+        cum_pop    = np.cumsum(donor_pop[order])
+        cum_suit   = np.cumsum(donor_suit[order])
+        
+        # Population held by the leading donors when the level reaches the next threshold
+        held = cum_pop - cum_suit * np.append(thresholds[1:], 0)
+        last = min(np.searchsorted(held, target), len(held) - 1)
+        
+        level = max((cum_pop[last] - target)/cum_suit[last], 0)
+        redistribution["level"] = float(level)
+        
+        pop_estimates = pop_estimates.copy()
+        pop_estimates[donors] = np.maximum(donor_pop - donor_suit * level, 0)
+    
+    redistribution["clipped_cells"] = int(negative.sum() + (pop_estimates[donors] == 0).sum())
+    pop_estimates = np.maximum(pop_estimates, 0)
+    
+    return pop_estimates, redistribution
+
+
+
+def pop_estimator(engine, a, b, points_mask, pop_t1_array, pop_change, negative_mod):
+    
+    # Engines that fuse the mask and decline adjustments into their own loop allocate directly
+    if hasattr(engine, "allocate"):
+        return engine.allocate(a, b, points_mask, pop_t1_array, pop_change, negative_mod)
+    
+    suitability_estimates = engine.evaluate(a, b)
+    
+    return pop_allocator(suitability_estimates, points_mask, pop_t1_array, pop_change, negative_mod)
+
+
+
+def pop_min_function(z, *params):
+    
+    #Initialize the parameters
+    a,b = z
+
+    # Inputs to the optimization
+    population_1st  = params[0] # Population of points in the first year (urban/rural)
+    population_2nd  = params[1] # Population of points in the second year (urban/rural)
+    points_mask     = params[2] # Mask values of points 
+    dist_matrix     = params[3] # Template distance matrix
+    within_indices  = params[4] # Indices of points within the state boundary (subset of the above)
+    shape           = params[5] # Number of rows and columns of the population grid
+    engine          = params[6] # Suitability engine name (see suitability_engine) or a prebuilt engine
+    
+    # Parts of the objective that do not depend on alpha and beta
+    pop_t1_array, pop_t2_array, pop_change, negative_mod, points_mask = objective_inputs(
+        population_1st, population_2nd, points_mask, within_indices)
+    
+    # Population estimates in the second year, releasing the engine only if it was built for this call
+    cur_engine = suitability_engine(engine, population_1st, dist_matrix, within_indices, shape)
+    try:
+        pop_estimates, _ = pop_estimator(cur_engine, a, b, points_mask, pop_t1_array, pop_change, negative_mod)
+    finally:
+        if cur_engine is not engine:
+            cur_engine.close()
+
+    # Produce the total error compared to observed values 
+    tot_error = abs(pop_t2_array - pop_estimates).sum()
+    
+    print("the first run is done")
     
     return tot_error
+
+
+
+def pop_grid_search(a_list, b_list, *params):
+    
+    # Inputs are the same as those of pop_min_function
+    population_1st  = params[0]
+    population_2nd  = params[1]
+    points_mask     = params[2]
+    dist_matrix     = params[3]
+    within_indices  = params[4]
+    shape           = params[5]
+    engine          = params[6]
+    
+    # Parts of the objective that do not depend on alpha and beta are derived only once
+    pop_t1_array, pop_t2_array, pop_change, negative_mod, points_mask = objective_inputs(
+        population_1st, population_2nd, points_mask, within_indices)
+    
+    # Suitability estimates of the whole grid, in one batched pass when the engine supports it
+    cur_engine = suitability_engine(engine, population_1st, dist_matrix, within_indices, shape)
+    try:
+        if hasattr(cur_engine, "evaluate_grid"):
+            suitability_grid = cur_engine.evaluate_grid(a_list, b_list)
+        else:
+            suitability_grid = np.array([[cur_engine.evaluate(a, b) for b in b_list] for a in a_list])
+    finally:
+        if cur_engine is not engine:
+            cur_engine.close()
+    
+    # Total error of every (alpha, beta) pair
+    estimates = np.empty((len(a_list), len(b_list)))
+    for i in range(len(a_list)):
+        for j in range(len(b_list)):
+            pop_estimates, _ = pop_allocator(suitability_grid[i, j], points_mask, pop_t1_array, 
+                                             pop_change, negative_mod)
+            estimates[i, j] = abs(pop_t2_array - pop_estimates).sum()
+    
+    grid_results = pd.DataFrame(data={'a'        : np.repeat(a_list, len(b_list)).astype(np.float32),
+                                      'b'        : np.tile(b_list, len(a_list)).astype(np.float32),
+                                      'estimate' : estimates.ravel()})
+    
+    return grid_results
+
+
+
+def inputs_fingerprint(*params):
+    
+    # Hash of everything that affects the objective apart from alpha and beta. Prebuilt engines are named
+    # by their type, and truncated ones also by their inner engine and tolerance
+    engine = params[6] if isinstance(params[6], str) else type(params[6]).__name__
+    if isinstance(params[6], TruncatedSuitability):
+        engine = "{}({}, {!r})".format(engine, params[6].engine, params[6].tolerance)
+    
+    fingerprint = hashlib.sha1()
+    for array in (params[0], params[1], params[2], params[4], params[3]["ind_diff"].values, 
+                  params[3]["dis"].values):
+        fingerprint.update(np.ascontiguousarray(array).tobytes())
+    fingerprint.update(repr((tuple(params[5]), engine)).encode())
+    
+    return fingerprint.hexdigest()
+
+
+
+class ObjectiveCache:
+    """
+    Persistent memoization of pop_min_function. Evaluations are keyed by a hash
+    of the borough inputs and the rounded (alpha, beta) pair. Each one is
+    appended to a CSV file as soon as it is computed, so repeated, resumed or
+    widened calibrations reuse earlier evaluations.
+    """
+    
+    def __init__(self, cache_file, params, decimals=6):
+        
+        self.cache_file  = cache_file
+        self.decimals    = decimals
+        self.fingerprint = inputs_fingerprint(*params)
+        self.hits        = 0
+        self.misses      = 0
+        
+        # Previous evaluations of the same inputs
+        self.values = {}
+        if os.path.exists(cache_file):
+            cached = pd.read_csv(cache_file, dtype={"inputs": str})
+            cached = cached.loc[cached["inputs"] == self.fingerprint]
+            self.values = {self.key(a, b): estimate for a, b, estimate in 
+                           zip(cached["a"], cached["b"], cached["estimate"])}
+    
+    
+    def key(self, a, b):
+        
+        return (round(float(a), self.decimals), round(float(b), self.decimals))
+    
+    
+    def store(self, pairs, estimates):
+        
+        records = pd.DataFrame({"inputs": self.fingerprint, "a": [a for a, b in pairs], 
+                                "b": [b for a, b in pairs], "estimate": estimates})
+        records.to_csv(self.cache_file, mode="a", index=False, header=not os.path.exists(self.cache_file))
+        
+        for (a, b), estimate in zip(pairs, estimates):
+            self.values[self.key(a, b)] = estimate
+    
+    
+    def __call__(self, z, *params):
+        
+        key = self.key(*z)
+        if key in self.values:
+            self.hits += 1
+            return self.values[key]
+        
+        self.misses += 1
+        estimate = pop_min_function(z, *params)
+        self.store([key], [estimate])
+        
+        return estimate
+    
+    
+    def grid_search(self, a_list, b_list, *params):
         
+        pairs   = [self.key(a, b) for a in a_list for b in b_list]
+        missing = [(a, b) for a in a_list for b in b_list if self.key(a, b) not in self.values]
+        
+        # Only the missing points are evaluated. Betas missing the same alphas form a sub-grid that is
+        # evaluated in one batched pass, so a grid that is missing entirely takes a single pass
+        missing_alphas = {}
+        for a, b in missing:
+            missing_alphas.setdefault(b, []).append(a)
+        sub_grids = {}
+        for b, a_missing in missing_alphas.items():
+            sub_grids.setdefault(tuple(a_missing), []).append(b)
+        
+        for a_missing, b_missing in sub_grids.items():
+            grid_results = pop_grid_search(list(a_missing), b_missing, *params)
+            self.store([(a, b) for a in a_missing for b in b_missing], grid_results["estimate"].values)
+        
+        self.hits   += len(pairs) - len(missing)
+        self.misses += len(missing)
+        
+        grid_results = pd.DataFrame(data={'a'        : np.repeat(a_list, len(b_list)).astype(np.float32),
+                                          'b'        : np.tile(b_list, len(a_list)).astype(np.float32),
+                                          'estimate' : [self.values[pair] for pair in pairs]})
+        
+        return grid_results
+    
+    
+    def report(self):
+        
+        calls = self.hits + self.misses
+        rate  = self.hits / calls if calls else 0.0
+        
+        return "objective cache: {} hits, {} misses ({:.0%} hit rate)".format(self.hits, self.misses, rate)
 
 
+
+class SuitabilityCache:
+    """
+    Unmasked suitability estimates of the projection kept on disk. They are
+    keyed by a hash of everything they depend on: the population grid, the
+    within-boundary cells, the stencil, the engine and alpha and beta. The mask
+    only enters the allocation, so a projection rerun with a revised mask skips
+    the engine for the first decade. Later decades start from grids projected
+    under the mask and are not cached.
+    """
+    
+    def __init__(self, cache_dir, engine, stencil_cache=None, tolerance=None):
+        
+        self.cache_dir     = cache_dir
+        self.engine        = engine
+        self.stencil_cache = stencil_cache
+        self.tolerance     = tolerance
+        self.hits          = 0
+        self.misses        = 0
+        
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    
+    def evaluate(self, population, dist_matrix, within_indices, shape, a, b):
+        
+        fingerprint = hashlib.sha1()
+        for array in (population, within_indices, dist_matrix["row_diff"].values, 
+                      dist_matrix["col_diff"].values, dist_matrix["dis"].values):
+            fingerprint.update(np.ascontiguousarray(array).tobytes())
+        fingerprint.update(repr((tuple(shape), self.engine, self.tolerance, float(a), float(b))).encode())
+        cache_file = os.path.join(self.cache_dir, "suitability_" + fingerprint.hexdigest() + ".npy")
+        
+        if os.path.exists(cache_file):
+            self.hits += 1
+            return np.load(cache_file)
+        
+        self.misses += 1
+        engine = suitability_engine(self.engine, population, dist_matrix, within_indices, shape, 
+                                    self.stencil_cache, self.tolerance)
+        try:
+            suitability_estimates = engine.evaluate(a, b)
+        finally:
+            engine.close()
+        np.save(cache_file, suitability_estimates)
+        
+        return suitability_estimates
+    
+    
+    def report(self):
+        
+        calls = self.hits + self.misses
+        rate  = self.hits / calls if calls else 0.0
+        
+        return "suitability cache: {} hits, {} misses ({:.0%} hit rate)".format(self.hits, self.misses, rate)
+
+
+
+def mask_difference(window, old_mask_raster, new_mask_raster):
+    
+    # Cells of the window whose mask value changed; NaN cells that stay NaN are unchanged
+    old_mask = window.read(old_mask_raster)
+    new_mask = window.read(new_mask_raster)
+    changed  = (old_mask != new_mask) & ~(np.isnan(old_mask) & np.isnan(new_mask))
+    
+    return np.flatnonzero(changed)
+
+
+
+def pyramid_level(params, resolution, cut_off_meters, factor, engine, cache_dir=None, tolerance=None):
+    
+    # Inputs are the same as those of pop_min_function; the engine is rebuilt at the coarse level
+    population_1st  = params[0]
+    population_2nd  = params[1]
+    points_mask     = params[2]
+    within_indices  = params[4]
+    shape           = params[5]
+    
+    # Aggregate the population (sum) and mask (mean) grids to the coarser level
+    coarse_1st, coarse_shape = raster_aggregator(population_1st, shape, factor, "sum")
+    coarse_2nd, _            = raster_aggregator(population_2nd, shape, factor, "sum")
+    coarse_mask, _           = raster_aggregator(points_mask, shape, factor, "mean")
+    coarse_within            = index_aggregator(within_indices, shape, factor)
+    
+    # The same neighborhood covers correspondingly fewer, larger cells. Beta is per km and carries over,
+    # but a power of a block sum is not a fixed multiple of the sum of powers when alpha != 1, so the
+    # coarse optimum only approximates the full resolution one and serves as its starting point
+    coarse_resolution = (resolution[0] * factor, resolution[1] * factor)
+    coarse_dist       = stencil_generator(coarse_shape, coarse_resolution, cut_off_meters, cache_dir)
+    coarse_engine     = suitability_engine(engine, coarse_1st, coarse_dist, coarse_within, coarse_shape,
+                                           cache_dir, tolerance)
+    
+    return (coarse_1st, coarse_2nd, coarse_mask, coarse_dist, coarse_within, coarse_shape, coarse_engine)
+
+
+
+class ProjectionSession:
+    """
+    Warm projection inputs of a borough for repeated what-if queries. The mask,
+    within-boundary cells, raster window and stencil are loaded once, and the
+    suitability engine of the latest starting grid is kept (with its pools and
+    spectra) until a query starts from another grid. Each call to project
+    returns the allocated population of the within-boundary cells and records
+    its latency.
+    """
+    
+    def __init__(self, mask_raster, point_indices, neighborhood_dis, engine="fft", start_grid=None, 
+                 cache_dir=None, tolerance=None, suitability_cache=None):
+        
+        self.engine_name       = engine
+        self.cache_dir         = cache_dir
+        self.tolerance         = tolerance
+        self.suitability_cache = suitability_cache
+        
+        # Static inputs of the borough
+        self.window      = RasterWindow(mask_raster, read_within_indices(point_indices), neighborhood_dis)
+        self.mask_array  = self.window.read(mask_raster)
+        self.points_mask = raster_array_modifier(self.mask_array, self.window.within_indices)
+        self.dist_matrix = stencil_generator(self.window.shape, self.window.resolution, neighborhood_dis, 
+                                             cache_dir)
+        
+        # Starting grids read so far and the engine of the latest one
+        self.start_grid  = start_grid
+        self.populations = {}
+        self.engine      = None
+        self.engine_key  = None
+        self.latencies   = []
+    
+    
+    def population(self, start_grid):
+        
+        # Starting grids are raster files (read once) or arrays over the session window
+        if isinstance(start_grid, str):
+            if start_grid not in self.populations:
+                self.populations[start_grid] = self.window.read(start_grid)
+            return start_grid, self.populations[start_grid]
+        
+        population = np.asarray(start_grid, dtype=np.float64)
+        
+        return hashlib.sha1(population.tobytes()).hexdigest(), population
+    
+    
+    def project(self, total, alpha, beta, start_grid=None):
+        
+        start = time.perf_counter()
+        
+        key, population = self.population(self.start_grid if start_grid is None else start_grid)
+        reused          = key == self.engine_key
+        
+        # Population change of the borough
+        pop_first_year = raster_array_modifier(population, self.window.within_indices)
+        pop_change     = total - pop_first_year.sum()
+        negative_mod   = 1 if pop_change < 0 else 0
+        points_mask    = mask_modifier(self.points_mask.copy(), pop_first_year, negative_mod)
+        
+        if self.suitability_cache is not None:
+            suitability_estimates = self.suitability_cache.evaluate(population, self.dist_matrix, 
+                                                                    self.window.within_indices, 
+                                                                    self.window.shape, alpha, beta)
+            pop_estimates, redistribution = pop_allocator(suitability_estimates, points_mask, pop_first_year,
+                                                          pop_change, negative_mod)
+        else:
+            
+            # The engine is rebuilt only when the starting grid changes
+            if not reused:
+                if self.engine is not None:
+                    self.engine.close()
+                self.engine     = suitability_engine(self.engine_name, population, self.dist_matrix, 
+                                                     self.window.within_indices, self.window.shape, 
+                                                     self.cache_dir, self.tolerance)
+                self.engine_key = key
+            
+            pop_estimates, redistribution = pop_estimator(self.engine, alpha, beta, points_mask, 
+                                                          pop_first_year, pop_change, negative_mod)
+        
+        self.latencies.append({"seconds": time.perf_counter() - start, "engine_reused": reused, 
+                               "negative_cells": redistribution["negative_cells"]})
+        
+        return pop_estimates
+    
+    
+    def write(self, output_raster, pop_estimates):
+        
+        self.window.write(output_raster, pop_estimates)
+    
+    
+    def metrics(self):
+        
+        latencies = pd.DataFrame(self.latencies, columns=["seconds", "engine_reused", "negative_cells"])
+        seconds   = latencies["seconds"]
+        
+        return {"requests"      : len(latencies), 
+                "mean_seconds"  : float(seconds.mean()) if len(seconds) else 0.0,
+                "p50_seconds"   : float(seconds.quantile(0.5)) if len(seconds) else 0.0, 
+                "p95_seconds"   : float(seconds.quantile(0.95)) if len(seconds) else 0.0,
+                "max_seconds"   : float(seconds.max()) if len(seconds) else 0.0,
+                "engine_reuses" : int(latencies["engine_reused"].sum())}
+    
+    
+    def close(self):
+        
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
+
+
+
+def serve_projection_session(session, address=("localhost", 6010), authkey=None):
+    
+    # Requests are (method, kwargs) pairs for project, write or metrics, and shutdown stops the service.
+    # Every reply is a ("ok", result) or ("error", message) pair
+    
+    # Requests are unpickled, so only clients that share the authkey may connect
+    if not authkey:
+        raise ValueError("an authkey is required to serve a projection session")
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            print("projection session listening on {}:{}".format(*address))
+            
+            serving = True
+            while serving:
+                # Clients failing the handshake are dropped without stopping the service
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, ConnectionError, EOFError):
+                    continue
+                
+                with connection:
+                    while True:
+                        try:
+                            method, kwargs = connection.recv()
+                        except EOFError:
+                            break
+                        
+                        if method == "shutdown":
+                            connection.send(("ok", session.metrics()))
+                            serving = False
+                            break
+                        
+                        try:
+                            if method not in ("project", "write", "metrics"):
+                                raise ValueError("unknown method: " + str(method))
+                            connection.send(("ok", getattr(session, method)(**kwargs)))
+                        except Exception as error:
+                            connection.send(("error", repr(error)))
+    finally:
+        session.close()